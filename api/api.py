@@ -1,11 +1,13 @@
 '''The API calls'''
 
+from datetime import datetime, timezone
 from enum import auto, Enum, unique
-from io import BytesIO
+from itertools import chain
 import json
 import os
 import re
 
+import click
 from flask import (
     abort,
     g,
@@ -14,23 +16,23 @@ from flask import (
     redirect,
     request,
     Response,
-    send_file,
     stream_with_context,
     send_from_directory,
 )
 import sqlalchemy
 from sqlalchemy import (
-    between,
     cast,
     desc as sql_desc,
     distinct,
     Float,
     func,
-    or_,
 )
-from sqlalchemy.sql.expression import and_
 
 from . import app, taxtree
+from .area_index import get_record_index, get_record_indexes
+from .cache import cached_payload, memoise
+from .resolver import get_resolver
+from .sequence_store import build_store
 from .asdb_jobs import (
     dispatchBlast,
     dispatchStoredQuery,
@@ -39,8 +41,17 @@ from .asdb_jobs import (
 )
 from .search import (
     core_search,
+    count_results_within,
+    decode_cursor,
+    estimate_results,
     format_results,
+    format_results_batched,
+    next_cursor,
+    paginated_search,
     region_stats,
+    DEFAULT_FACETS,
+    result_count,
+    result_ids,
     available_term_by_category,
 )
 from .search.clusters import CLUSTERS as CLUSTER_HANDLERS
@@ -50,6 +61,7 @@ from .search.filters import (
     available_filters_by_category,
 )
 from .search.helpers import (
+    id_filter,
     InvalidQueryError,
     TextFilter,
     UnknownQueryError,
@@ -61,7 +73,6 @@ from .models import (
     BgcType,
     Region,
     DnaSequence,
-    Filename,
     Genome,
     Taxa,
     t_rel_regions_types,
@@ -77,12 +88,6 @@ MIME_TYPE_MAP = {
     'fastaa': 'application/fasta',
 }
 
-FASTA_LIMITS = {
-    'cluster': 100,
-    'gene': 500,
-    'domain': 500
-}
-
 SAFE_IDENTIFIER_PATTERN = re.compile('[^A-Za-z0-9_.]+', re.UNICODE)
 
 
@@ -134,9 +139,8 @@ def _common_stats():
     return stats
 
 
-@app.route('/api/v1.0/stats')
-def get_stats_v1():
-    '''contents for the stats page'''
+def _stats_v1():
+    '''Build the v1 stats payload'''
     stats = _common_stats()
 
     ret = db.session.query(Taxa.tax_id, Taxa.genus, Taxa.species, Taxa.strain,
@@ -151,13 +155,11 @@ def get_stats_v1():
     stats['top_secmet_acc'] = ret.accession
     stats['top_secmet_taxon_count'] = ret.clusters_per_seq
 
-    return jsonify(stats)
+    return json.dumps(stats).encode('utf-8')
 
 
-@app.route('/api/stats')
-@app.route('/api/v2.0/stats')
-def get_stats_v2():
-    """contents for the stats page"""
+def _stats_v2():
+    """Build the v2 stats payload"""
     stats = _common_stats()
 
     ret = db.session.query(Taxa.tax_id, Taxa.genus, Taxa.species, Taxa.strain,
@@ -173,30 +175,99 @@ def get_stats_v2():
     stats['top_secmet_assembly_id'] = ret.assembly_id
     stats['top_secmet_taxon_count'] = ret.bgc_count
 
-    return jsonify(stats)
+    return json.dumps(stats).encode('utf-8')
 
 
-@app.route('/api/v1.0/tree/secmet')
-def get_sec_met_tree():
-    '''Get the jsTree structure for secondary metabolite clusters'''
-    ret = db.session.query(Region.region_id, Region.region_number,
-                           DnaSequence.accession,
-                           BgcType.term, BgcType.description,
-                           Taxa.genus, Taxa.species, Taxa.strain, Genome.assembly_id) \
-                    .join(DnaSequence, DnaSequence.accession == Region.accession).join(Genome).join(Taxa) \
-                    .join(t_rel_regions_types).join(BgcType) \
-                    .order_by(BgcType.description, Taxa.genus, Taxa.species, DnaSequence.accession, Region.region_number) \
-                    .all()
+STATS_BUILDERS = {
+    'v1': _stats_v1,
+    'v2': _stats_v2,
+}
 
-    clusters = []
-    types = {}
 
-    for entry in ret:
-        types[entry.term] = entry.description
+def _cached_json_response(payload, built, etag):
+    """Serve a pre-serialised JSON payload, honouring conditional requests"""
+    response = Response(payload, mimetype='application/json')
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(int(built), tz=timezone.utc)
+    return response.make_conditional(request)
+
+
+def refresh_stats():
+    """Rebuild the cached stats and secondary metabolite tree payloads"""
+    for version, builder in STATS_BUILDERS.items():
+        cached_payload(f'stats.{version}', builder, refresh=True)
+    cached_payload('tree.secmet', _sec_met_tree, refresh=True)
+
+
+@app.cli.command('refresh-stats')
+def refresh_stats_command():
+    """Rebuild the cached stats payloads, e.g. after a database reload"""
+    if app.config.get('CACHE_BACKEND', 'local') == 'local':
+        # the payloads would only end up in this process, not in the workers' own caches
+        raise click.ClickException("refreshing has no effect with the local cache backend, "
+                                   "use the filesystem or socket backend")
+    refresh_stats()
+
+
+@app.cli.command('build-sequence-store')
+@click.argument('path', required=False)
+def build_sequence_store_command(path):
+    """Build the packed DNA store for the current database contents"""
+    path = path or app.config['SEQUENCE_STORE']
+    if not path:
+        raise click.UsageError("no path given and SEQUENCE_STORE not set")
+    count = build_store(path)
+    click.echo("stored {} records in {}".format(count, path))
+
+
+@app.route('/api/v1.0/stats')
+def get_stats_v1():
+    '''contents for the stats page'''
+    return _cached_json_response(*cached_payload('stats.v1', _stats_v1))
+
+
+@app.route('/api/stats')
+@app.route('/api/v2.0/stats')
+def get_stats_v2():
+    """contents for the stats page"""
+    return _cached_json_response(*cached_payload('stats.v2', _stats_v2))
+
+
+def _sec_met_type_nodes(lazy=False):
+    '''Get the jsTree nodes of all BGC types with regions, sorted by type'''
+    types = db.session.query(BgcType.term, BgcType.description).join(t_rel_regions_types).distinct()
+    nodes = []
+    for term, description in sorted(types):
+        node = {
+            "id": term,
+            "parent": "#",
+            "text": description,
+            "state": {
+                "disabled": True
+            }
+        }
+        if lazy:
+            node["children"] = True
+        nodes.append(node)
+    return nodes
+
+
+def _sec_met_region_nodes(term=None):
+    '''Get the jsTree nodes of the regions of all BGC types, or only of the given type'''
+    query = db.session.query(Region.region_number, DnaSequence.accession, BgcType.term,
+                             Taxa.genus, Taxa.species, Taxa.strain, Genome.assembly_id) \
+                      .join(DnaSequence, DnaSequence.accession == Region.accession).join(Genome).join(Taxa) \
+                      .join(t_rel_regions_types).join(BgcType)
+    if term is not None:
+        query = query.filter(BgcType.term == term)
+    query = query.order_by(BgcType.description, Taxa.genus, Taxa.species, DnaSequence.accession, Region.region_number)
+
+    nodes = []
+    for entry in query.yield_per(app.config.get('SEARCH_STREAM_BATCH_SIZE', 10000)):
         species = entry.species if entry.species != 'Unclassified' else 'sp.'
         assembly_id = entry.assembly_id.split('.')[0] if entry.assembly_id else None
         name = '{} {} {}'.format(entry.genus, species, entry.strain)
-        clusters.append({
+        nodes.append({
             "id": "{}_c{}_{}".format(entry.accession, entry.region_number, entry.term),
             "parent": entry.term,
             "text": "{} {} Region {}".format(name, entry.accession, entry.region_number),
@@ -204,19 +275,47 @@ def get_sec_met_tree():
             "region_number": entry.region_number,
             "type": "cluster",
         })
+    return nodes
 
-    for name, desc in sorted(list(types.items()), reverse=True):
-        clusters.insert(0, {
-            "id": name,
-            "parent": "#",
-            "text": desc,
-            "state": {
-                "disabled": True
-            }
-        })
 
-    tree = clusters
-    return jsonify(tree)
+@memoise('tree.secmet.terms')
+def _sec_met_terms():
+    '''Get the terms of all known BGC types'''
+    return [term for term, in db.session.query(BgcType.term)]
+
+
+def _sec_met_tree(tree_id=None):
+    '''Build the serialised secondary metabolite tree, or a single level of it
+
+       Without an id, the whole tree is built. With the root id, only the BGC
+       type nodes are built, each marked as having children to load, and with
+       the id of a BGC type, only the regions of that type.
+    '''
+    if tree_id is None:
+        tree = _sec_met_type_nodes() + _sec_met_region_nodes()
+    elif tree_id == '#':
+        tree = _sec_met_type_nodes(lazy=True)
+    else:
+        tree = _sec_met_region_nodes(tree_id)
+    return json.dumps(tree).encode('utf-8')
+
+
+@app.route('/api/v1.0/tree/secmet')
+def get_sec_met_tree():
+    '''Get the jsTree structure for secondary metabolite clusters
+
+       The whole tree is returned by default, the id parameter selects a
+       single level of it instead, as for the taxa tree. Both '#' and '1'
+       select the root level.
+    '''
+    tree_id = request.args.get('id')
+    if tree_id is None:
+        return _cached_json_response(*cached_payload('tree.secmet', _sec_met_tree))
+    if tree_id in ('#', '1'):
+        tree_id = '#'
+    elif tree_id not in _sec_met_terms():
+        return jsonify([])
+    return _cached_json_response(*cached_payload('tree.secmet', _sec_met_tree, args=(tree_id,)))
 
 
 def _get_taxon_tree_node(tree_id):
@@ -275,8 +374,8 @@ def search_taxon_tree():
     return jsonify(search_path)
 
 
-def search_common():
-    """Shared logic between the v1 and v2 version of the /search endpoint."""
+def _search_query():
+    """Parse the query of a search request"""
     try:
         if 'query' not in request.json:
             query = Query.from_string(request.json.get('search_string', ''))
@@ -288,6 +387,19 @@ def search_common():
     if query.return_type != 'json':
         abort(400)
 
+    return query
+
+
+def search_common(paged=True):
+    """Shared logic between the v1 and v2 version of the /search endpoint.
+
+       If paged is set, only the requested page of results is loaded from the
+       database, otherwise no results are loaded and only the total is found.
+       Pages are selected either by offset or, if the request contains a
+       'cursor', by the opaque cursor token returned with the previous page.
+    """
+    query = _search_query()
+
     try:
         offset = int(request.json.get('offset', '0'))
     except ValueError:
@@ -299,27 +411,49 @@ def search_common():
         paginate = 50
 
     try:
-        results = core_search(query)
+        if paged:
+            after = decode_cursor(query, request.json.get('cursor'))
+            total, results = paginated_search(query, offset, paginate, after=after)
+        else:
+            results = []
+            total = result_count(query)
     except UnknownQueryError:
         abort(make_response({"message": "Unknown query category"}, 400))
     except InvalidQueryError as err:
         abort(make_response({"message": str(err)}, 400))
 
-    return query, results, offset, paginate
+    return query, total, results, offset, paginate
+
+
+def _requested_facets():
+    """Get the names of the extra facets requested by the client, if any"""
+    facets = request.json.get('facets') or []
+    if not isinstance(facets, list):
+        abort(make_response({"message": "'facets' must be a list of facet names"}, 400))
+    return [str(facet) for facet in facets]
+
+
+def _add_facets(result, query):
+    """Add the requested facets of the search results, if the client asked for any"""
+    facets = _requested_facets()
+    if facets:
+        result['facets'] = region_stats(query, facets)
+    return result
+
+
+def _add_cursor(result, query, results, paginate):
+    """Add the cursor for the next page, if the client is paging by cursor"""
+    if 'cursor' in request.json:
+        result['cursor'] = next_cursor(query, results, paginate)
+    return result
 
 
 @app.route('/api/v1.0/search', methods=['POST'])
 def search_v1():
-    query, results, offset, paginate = search_common()
-    stats = region_stats(results)
-    total = len(results)
+    query, total, results, offset, paginate = search_common()
+    stats = region_stats(query, list(DEFAULT_FACETS) + _requested_facets())
 
-    if paginate > 0:
-        end = min(offset + paginate, total)
-    else:
-        end = total
-
-    clusters = format_results(query, results[offset:end])
+    clusters = format_results(query, results)
 
     result = {
         'total': total,
@@ -329,18 +463,13 @@ def search_v1():
         'stats': stats,
     }
 
-    return jsonify(result)
+    return jsonify(_add_cursor(result, query, results, paginate))
 
 
 @app.route('/api/v2.0/search', methods=['POST'])
 def search():
-    query, results, offset, paginate = search_common()
-    total = len(results)
-    if paginate > 0:
-        end = min(offset + paginate, total)
-    else:
-        end = total
-    clusters = format_results(query, results[offset:end])
+    query, total, results, offset, paginate = search_common()
+    clusters = format_results(query, results)
 
 
     result = {
@@ -350,18 +479,13 @@ def search():
         'paginate': paginate,
     }
 
-    return jsonify(result)
+    return jsonify(_add_facets(_add_cursor(result, query, results, paginate), query))
 
 
 @app.route('/api/search', methods=['POST'])
 def search_regions():
-    query, results, offset, paginate = search_common()
-    total = len(results)
-    if paginate > 0:
-        end = min(offset + paginate, total)
-    else:
-        end = total
-    regions = format_results(query, results[offset:end])
+    query, total, results, offset, paginate = search_common()
+    regions = format_results(query, results)
 
 
     result = {
@@ -371,13 +495,37 @@ def search_regions():
         'paginate': paginate,
     }
 
-    return jsonify(result)
+    return jsonify(_add_facets(_add_cursor(result, query, results, paginate), query))
+
+
+@app.route('/api/search/count', methods=['POST'])
+def search_count():
+    """Quickly count the results of a search, e.g. while the query is still being edited
+
+       The planner's estimate is returned, unless 'exact' is requested and
+       the exact count finishes within the configured time budget.
+    """
+    query = _search_query()
+
+    try:
+        total = None
+        if request.json.get('exact'):
+            total = count_results_within(query, app.config.get('SEARCH_COUNT_TIMEOUT', 500))
+        exact = total is not None
+        if not exact:
+            total = estimate_results(query)
+    except UnknownQueryError:
+        abort(make_response({"message": "Unknown query category"}, 400))
+    except InvalidQueryError as err:
+        abort(make_response({"message": str(err)}, 400))
+
+    return jsonify({'total': total, 'exact': exact})
+
 
 @app.route('/api/v1.0/searchstats', methods=['POST'])
 def searchstats():
-    query, results, offset, paginate = search_common()
-    total = len(results)
-    stats = region_stats(results)
+    query, total, _, _, _ = search_common(paged=False)
+    stats = region_stats(query, list(DEFAULT_FACETS) + _requested_facets())
     result = {
         'total': total,
         'stats': stats,
@@ -404,19 +552,14 @@ def export_v4():
         app.logger.error("invalid return_type %s", return_type)
         abort(400)
 
+    if search_type not in {"region", "cluster", "gene", "domain"}:
+        app.logger.error("invalid search_type %s", search_type)
+        abort(400)
+
     try:
-        search_results = core_search(query)
-        if len(search_results) == 0:
+        ids = result_ids(query)
+        if not ids:
             abort(404)
-        if search_type in {"region", "cluster"}:
-            ids = list(map(lambda x: x.region_id, search_results))
-        elif search_type == "gene":
-            ids = list(map(lambda x: x.cds_id, search_results))
-        elif search_type == "domain":
-            ids = list(map(lambda x: x.as_domain_id, search_results))
-        else:
-            app.logger.error("invalid search_type %s", search_type)
-            abort(400)
     except UnknownQueryError as err:
         app.logger.error("unknown query error: %s", err)
         abort(400)
@@ -446,48 +589,77 @@ def export():
         paginate = 0
 
     return_type = query.return_type
-    search_type = query.search_type
 
     if return_type not in ('json', 'csv', 'fasta', 'fastaa'):
         abort(400)
 
     try:
-        search_results = core_search(query)
+        ids = result_ids(query)
     except UnknownQueryError:
         abort(400)
     g.verbose = query.verbose
     if query.verbose:
         g.search_str = str(query)
 
-    total = len(search_results)
+    total = len(ids)
 
     if paginate > 0:
         end = min(offset + paginate, total)
     else:
         end = total
 
-    search_results = search_results[offset:end]
+    ids = ids[offset:end]
+
+    _check_fasta_limit(query, ids)
+
+    filename = 'asdb_search_results.{}'.format(return_type)
+    return _export_response(query, ids, filename)
 
-    limit = FASTA_LIMITS.get(search_type, 100)
 
-    if return_type.startswith('fasta') and len(search_results) > limit:
+def _check_fasta_limit(query, ids):
+    """Refuse FASTA downloads of more results than configured in FASTA_LIMITS"""
+    limit = app.config['FASTA_LIMITS'].get(query.search_type, app.config['FASTA_LIMITS']['cluster'])
+    if query.return_type.startswith('fasta') and len(ids) > limit:
         raise TooManyResults('More than {limit} search results for FASTA {search} download ({number} found), please specify a smaller query.'.format(
-            limit=limit, search=search_type, number=len(search_results)))
+            limit=limit, search=query.search_type, number=len(ids)))
 
-    found_bgcs = format_results(query, search_results)
-    filename = 'asdb_search_results.{}'.format(return_type)
-    if query.return_type == 'json':
-        found_bgcs = [json.dumps(found_bgcs)]
 
-    handle = BytesIO()
-    for line in found_bgcs:
-        handle.write('{}\n'.format(line).encode('utf-8'))
+def _export_lines(query, ids):
+    """Generate the lines of an export, formatting the results batch by batch
 
-    handle.seek(0)
+       JSON is written as an incremental array, CSV headers are only kept for
+       the first batch. Batches are only formatted when the client has read the
+       previous ones, so memory use is bounded by the batch size.
+    """
+    if query.return_type.startswith('fasta'):
+        batch_size = app.config.get('FASTA_BATCH_SIZE', 100)
+    else:
+        batch_size = app.config.get('EXPORT_BATCH_SIZE', 1000)
+    batches = format_results_batched(query, ids, batch_size)
+    if query.return_type == 'json':
+        separator = '['
+        for batch in batches:
+            for entry in batch:
+                yield separator + json.dumps(entry)
+                separator = ', '
+        yield ('[' if separator == '[' else '') + ']\n'
+        return
+
+    for number, batch in enumerate(batches):
+        for index, line in enumerate(batch):
+            if number and not index and query.return_type == 'csv':
+                continue
+            yield line + '\n'
 
+
+def _export_response(query, ids, filename=None):
+    """Stream the formatted results for the ids"""
     mime_type = MIME_TYPE_MAP.get(query.return_type, None)
+    headers = {}
+    if filename:
+        headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
 
-    return send_file(handle, mimetype=mime_type, attachment_filename=filename, as_attachment=True)
+    return Response(stream_with_context(_export_lines(query, ids)), mimetype=mime_type, headers=headers)
 
 
 @app.route('/api/v1.0/export/<search_type>/<return_type>')
@@ -505,22 +677,13 @@ def export_get(search_type, return_type):
 
     g.verbose = False
     try:
-        search_results = core_search(query)
+        ids = result_ids(query)
     except UnknownQueryError:
         abort(400)
-    if len(search_results) > 100 and search_type == 'cluster' and return_type == 'fasta':
-        raise TooManyResults('More than 100 search results for FASTA cluster download, please specify a smaller query.')
-    found_bgcs = format_results(query, search_results)
-    if query.return_type == 'json':
-        found_bgcs = [json.dumps(found_bgcs)]
-
-    def generate():
-        for line in found_bgcs:
-            yield line + '\n'
-
-    mime_type = MIME_TYPE_MAP.get(query.return_type, None)
-
-    return Response(stream_with_context(generate()), mimetype=mime_type)
+    # only cluster FASTA downloads are limited here, as they always were
+    if query.search_type == 'cluster' and query.return_type == 'fasta':
+        _check_fasta_limit(query, ids)
+    return _export_response(query, ids)
 
 
 @app.route('/api/genome/<identifier>')
@@ -550,35 +713,64 @@ def list_available(category, term):
     return jsonify(available_term_by_category(category, term))
 
 
-def _canonical_assembly_id(identifier):
-    """Turn the identifier into an ID usable for lookups."""
+def _resolve_identifier(identifier, resolver):
+    """Turn the identifier into an ID usable for lookups, or None if unknown"""
     safe_id = SAFE_IDENTIFIER_PATTERN.sub('', identifier).split('.')[0]
     if safe_id in dbv1_accessions:
         return safe_id, True
 
-    res = db.session.query(Genome.assembly_id).filter(Genome.assembly_id.ilike("{}%".format(safe_id))).first()
-    if res:
-        return res.assembly_id, False
+    assembly_id = resolver.resolve(safe_id)
+    if assembly_id:
+        return assembly_id, False
+
+    return None
+
+
+def _canonical_assembly_id(identifier):
+    """Turn the identifier into an ID usable for lookups."""
+    resolved = _resolve_identifier(identifier, get_resolver())
+    if resolved is None:
+        abort(404)
+    return resolved
 
-    res = db.session.query(Genome.assembly_id) \
-                    .join(DnaSequence) \
-                    .filter(DnaSequence.accession.ilike("{}%".format(safe_id))) \
-                    .first()
-    if res:
-        return res.assembly_id, False
 
-    abort(404)
+def _output_url(safe_id, is_v1):
+    if is_v1:
+        return "https://antismash-dbv1.secondarymetabolites.org/output/{}/index.html".format(safe_id)
+    return "/output/{}/index.html".format(safe_id)
 
 
 @app.route('/api/goto/<identifier>')
 @app.route('/api/v1.0/goto/<identifier>')
 @app.route('/go/<identifier>')
 def goto(identifier):
-    safe_id, is_v1 = _canonical_assembly_id(identifier)
-    if is_v1:
-        return redirect("https://antismash-dbv1.secondarymetabolites.org/output/{}/index.html".format(safe_id))
+    return redirect(_output_url(*_canonical_assembly_id(identifier)))
 
-    return redirect("/output/{}/index.html".format(safe_id))
+
+@app.route('/api/goto', methods=['POST'])
+def goto_bulk():
+    """Resolve many accessions or assembly ids at once
+
+       Returns the canonical assembly id, whether it's from antiSMASH DB v1 and
+       the URL of the results for each identifier, in the order of the request.
+       Unknown identifiers have null ids and URLs.
+    """
+    identifiers = request.json.get('identifiers')
+    if not isinstance(identifiers, list) or not all(isinstance(identifier, str) for identifier in identifiers):
+        abort(400)
+    limit = app.config.get('GOTO_BATCH_LIMIT', 10000)
+    if len(identifiers) > limit:
+        raise TooManyResults('More than {} identifiers requested, please split the request.'.format(limit))
+
+    resolver = get_resolver()
+    results = []
+    for identifier in identifiers:
+        resolved = _resolve_identifier(identifier, resolver)
+        if resolved is None:
+            results.append({'identifier': identifier, 'assembly_id': None, 'dbv1': False, 'url': None})
+        else:
+            results.append({'identifier': identifier, 'assembly_id': resolved[0], 'dbv1': resolved[1], 'url': _output_url(*resolved)})
+    return jsonify({'results': results})
 
 
 @app.route('/api/v1.0/goto/<identifier>/cluster/<int:number>')
@@ -605,10 +797,7 @@ def goto_region(identifier, region):
 def area(record, version, start_pos, end_pos):
     safe_acc = SAFE_IDENTIFIER_PATTERN.sub('', record)
 
-    query = Region.query.join(DnaSequence, Region.dna_sequence).join(Genome, DnaSequence.genome)
-    query = query.filter(DnaSequence.accession == safe_acc).filter(DnaSequence.version == version)
-    query = _overlap_check(query, start_pos, end_pos)
-    res = query.all()
+    res = _overlapping_regions(safe_acc, start_pos, end_pos, version)
 
     # Right now format_results needs a Query object
     dummy = Query(None, search_type="cluster", return_type="json")
@@ -622,30 +811,22 @@ def area(record, version, start_pos, end_pos):
     return jsonify(result)
 
 
-def _overlap_check(query, start_pos, end_pos):
-    if end_pos < start_pos:
-        query = query.filter(or_(
-            Region.start_pos >= start_pos,
-            Region.end_pos > start_pos,
-            Region.start_pos <= end_pos,
-            Region.end_pos < end_pos,
-            Region.start_pos > Region.end_pos,
-        ))
-    else:
-        query = query.filter(or_(
-            Region.start_pos.between(start_pos, end_pos),
-            Region.end_pos.between(start_pos, end_pos),
-            between(start_pos, Region.start_pos, Region.end_pos),
-            between(end_pos, Region.start_pos, Region.end_pos),
-            and_(
-                Region.start_pos > Region.end_pos,
-                or_(
-                    Region.end_pos >= end_pos,
-                    Region.start_pos <= start_pos,
-                )
-            )
-        ))
-    return query
+def _window_region_ids(index, version, start_pos, end_pos):
+    '''Find the ids of the regions overlapping the area in the record's interval index'''
+    if index is None or (version is not None and index.version != version):
+        return []
+    return sorted(index.overlapping(start_pos, end_pos))
+
+
+def _load_regions(ids):
+    if not ids:
+        return []
+    return Region.query.filter(id_filter(Region.region_id, ids)).order_by(Region.region_id).all()
+
+
+def _overlapping_regions(accession, start_pos, end_pos, version=None):
+    '''Load the regions of a record overlapping the area, using the record's interval index'''
+    return _load_regions(_window_region_ids(get_record_index(accession), version, start_pos, end_pos))
 
 
 @app.route('/api/area/<record>/<int:start_pos>-<int:end_pos>')
@@ -653,10 +834,7 @@ def _overlap_check(query, start_pos, end_pos):
 def area_without_version(record, start_pos, end_pos):
     safe_acc = SAFE_IDENTIFIER_PATTERN.sub('', record)
 
-    query = Region.query.join(DnaSequence, Region.dna_sequence).join(Genome, DnaSequence.genome)
-    query = query.filter(DnaSequence.accession == safe_acc)
-    query = _overlap_check(query, start_pos, end_pos)
-    res = query.all()
+    res = _overlapping_regions(safe_acc, start_pos, end_pos)
 
     # Right now format_results needs a Query object
     dummy = Query(None, search_type="cluster", return_type="json")
@@ -670,14 +848,59 @@ def area_without_version(record, start_pos, end_pos):
     return jsonify(result)
 
 
+def _area_windows():
+    '''Parse and validate the [accession, version, start, end] windows of a batch area request'''
+    windows = request.json.get('windows')
+    if not isinstance(windows, list):
+        abort(400)
+    limit = app.config.get('AREA_BATCH_LIMIT', 1000)
+    if len(windows) > limit:
+        raise TooManyResults('More than {} windows requested, please split the request.'.format(limit))
+    parsed = []
+    for window in windows:
+        if not isinstance(window, list) or len(window) != 4:
+            abort(400)
+        accession, version, start_pos, end_pos = window
+        if not isinstance(accession, str) or not all(isinstance(value, int) for value in (start_pos, end_pos)) \
+                or not (version is None or isinstance(version, int)):
+            abort(400)
+        parsed.append((SAFE_IDENTIFIER_PATTERN.sub('', accession), version, start_pos, end_pos))
+    return parsed
+
+
+@app.route('/api/area', methods=['POST'])
+def area_batch():
+    """Look up the regions overlapping many windows at once
+
+       Takes a list of [accession, version, start, end] windows, the version
+       may be null to match any version. Each region is only formatted once,
+       the windows refer to them by their bgc_id, in the order of the request.
+    """
+    windows = _area_windows()
+    indexes = get_record_indexes(accession for accession, _, _, _ in windows)
+    matches = [_window_region_ids(indexes.get(accession), version, start_pos, end_pos)
+               for accession, version, start_pos, end_pos in windows]
+
+    res = _load_regions(sorted(set(chain.from_iterable(matches))))
+    dummy = Query(None, search_type="cluster", return_type="json")
+    clusters = format_results(dummy, res)
+
+    return jsonify({
+        "regions": clusters,
+        "windows": [
+            {"accession": accession, "version": version, "start": start_pos, "end": end_pos, "regions": ids}
+            for (accession, version, start_pos, end_pos), ids in zip(windows, matches)
+        ],
+    })
+
+
 def _get_base_url(identifier):
     safe_id = SAFE_IDENTIFIER_PATTERN.sub('', identifier).split('.')[0]
-    ret = db.session.query(Filename.assembly_id, Filename.base_filename) \
-            .filter(Filename.assembly_id == safe_id).first()
-    if not ret:
+    base_filename = get_resolver().base_filename(safe_id)
+    if base_filename is None:
         abort(404)
 
-    return "/output/{r.assembly_id}/{r.base_filename}".format(r=ret)
+    return "/output/{}/{}".format(safe_id, base_filename)
 
 
 @app.route('/api/v1.0/download/genbank/<identifier>')
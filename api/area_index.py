@@ -0,0 +1,128 @@
+'''Interval indexes of the region coordinates of records, for area overlap lookups
+
+Each record's regions are held in arrays sorted by start position. Regions of a
+record rarely overlap each other, so a lookup only needs to check the regions
+starting between the query start minus the longest region and the query end,
+found by binary search. Regions crossing the origin of a circular record, with
+an end before their start, are kept apart and checked separately.
+
+Indexes are built on first use per worker and kept in a bounded LRU, which is
+reset when the database contents change.
+'''
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from math import inf
+import threading
+from typing import Iterable, Optional
+
+from flask import current_app
+
+from .cache import database_version
+from .models import (
+    db,
+    DnaSequence,
+    Region,
+)
+from .search.helpers import id_filter
+
+
+class IntervalIndex:
+    '''Overlap lookups for the regions of a single record
+
+       Coordinates are inclusive on both ends, as in the regions table.
+    '''
+
+    def __init__(self, version: Optional[int], regions: Iterable[tuple[int, int, int]]) -> None:
+        self.version = version
+        linear = []
+        self.wrapping = []
+        for region_id, start, end in regions:
+            if start > end:
+                self.wrapping.append((start, end, region_id))
+            else:
+                linear.append((start, end, region_id))
+        linear.sort()
+        self.starts = array('q', (start for start, _, _ in linear))
+        self.ends = array('q', (end for _, end, _ in linear))
+        self.ids = array('q', (region_id for _, _, region_id in linear))
+        self.max_length = max((end - start for start, end, _ in linear), default=0)
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.wrapping)
+
+    def _linear_overlaps(self, start: float, end: float) -> list[int]:
+        '''Find the non-wrapping regions overlapping start to end'''
+        first = bisect_left(self.starts, start - self.max_length)
+        last = bisect_right(self.starts, end)
+        return [self.ids[i] for i in range(first, last) if self.ends[i] >= start]
+
+    def overlapping(self, start: int, end: int) -> list[int]:
+        '''Find the ids of the regions overlapping the area, in no particular order
+
+           If the end is before the start, the area crosses the origin and covers
+           everything from the start onwards and everything up to the end.
+        '''
+        if end < start:
+            found = set(self._linear_overlaps(start, inf))
+            found.update(self._linear_overlaps(-inf, end))
+            # regions crossing the origin always overlap an area crossing the origin
+            return list(found) + [region_id for _, _, region_id in self.wrapping]
+
+        found = self._linear_overlaps(start, end)
+        # a region crossing the origin covers everything from its start and up to its end
+        found.extend(region_id for region_start, region_end, region_id in self.wrapping
+                     if region_start <= end or region_end >= start)
+        return found
+
+
+def _build(rows: Iterable[tuple[str, Optional[int], int, int, int]]) -> dict[str, IntervalIndex]:
+    grouped = {}
+    for accession, version, region_id, start, end in rows:
+        entry = grouped.setdefault(accession, (version, []))
+        if region_id is not None:
+            entry[1].append((region_id, start, end))
+    return {accession: IntervalIndex(version, regions) for accession, (version, regions) in grouped.items()}
+
+
+_INDEXES = {'version': None, 'records': OrderedDict()}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_record_indexes(accessions: Iterable[str]) -> dict[str, IntervalIndex]:
+    '''Get the interval indexes of the records, loading all missing ones in a single query
+
+       Unknown accessions are left out of the result.
+    '''
+    accessions = set(accessions)
+    version = database_version()
+    limit = current_app.config.get('AREA_INDEX_CACHE_SIZE', 4096)
+    with _INDEXES_LOCK:
+        if _INDEXES['version'] != version:
+            _INDEXES['records'].clear()
+            _INDEXES['version'] = version
+        cached = _INDEXES['records']
+        found = {}
+        for accession in accessions:
+            if accession in cached:
+                cached.move_to_end(accession)
+                found[accession] = cached[accession]
+
+    missing = accessions.difference(found)
+    if missing:
+        rows = db.session.query(DnaSequence.accession, DnaSequence.version, Region.region_id, Region.start_pos, Region.end_pos) \
+            .outerjoin(Region, DnaSequence.regions).filter(id_filter(DnaSequence.accession, missing))
+        loaded = _build(rows)
+        found.update(loaded)
+        with _INDEXES_LOCK:
+            if _INDEXES['version'] == version:
+                cached.update(loaded)
+                while len(cached) > limit:
+                    cached.popitem(last=False)
+    return found
+
+
+def get_record_index(accession: str) -> Optional[IntervalIndex]:
+    '''Get the interval index of a single record, or None if the record is unknown'''
+    return get_record_indexes([accession]).get(accession)
@@ -3,6 +3,7 @@
 from dataclasses import dataclass, asdict
 from datetime import datetime
 import enum
+from typing import Iterable
 import uuid
 
 from flask_sqlalchemy import SQLAlchemy
@@ -57,14 +58,17 @@ def dispatchBlast(jobtype: JobType, name: str, sequence: str) -> Job:
     return job
 
 
-def dispatchStoredQuery(ids: list[int], search_type: str, return_type: str) -> Job:
-    """Dispatch a stored query job"""
+def dispatchStoredQuery(ids: Iterable[int], search_type: str, return_type: str) -> Job:
+    """Dispatch a stored query job
+
+    The ids can be any iterable of primary keys, e.g. an id-only search stream.
+    """
     job_id = str(uuid.uuid4())
 
     if search_type == "cluster":
         search_type = "region"
 
-    data = StoredQueryInput(job_id, ids, search_type, return_type)
+    data = StoredQueryInput(job_id, list(ids), search_type, return_type)
 
     job = Job(
         id=job_id,
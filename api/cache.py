@@ -0,0 +1,444 @@
+'''Pluggable caches shared by the search, stats, taxtree and typeahead code
+
+The backend is selected with the CACHE_BACKEND config option:
+    local:      an in-process LRU cache, not shared between workers
+    filesystem: files in CACHE_DIR, read via mmap and shared by all workers on a host
+    socket:     a memcached-compatible key-value server at CACHE_SOCKET, either
+                the path to a unix socket or host:port
+
+All backends store bytes. Cache failures are never fatal, a broken backend
+behaves like an empty cache.
+'''
+
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import json
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from flask import current_app
+from sqlalchemy import func
+
+from .models import db, Genome
+
+
+def _now() -> float:
+    return time.time()
+
+
+class CacheBackend:
+    '''The interface all cache backends provide'''
+
+    # the largest value the backend stores, in bytes, or None if unlimited
+    max_item_size = None
+
+    def get(self, key: str) -> Optional[bytes]:
+        '''Get the value stored for the key, or None if missing or expired'''
+        raise NotImplementedError()
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        '''Store the value for the key, optionally expiring after ttl seconds'''
+        raise NotImplementedError()
+
+    def delete(self, key: str) -> None:
+        '''Remove the value for the key, if present'''
+        raise NotImplementedError()
+
+    def clear(self) -> None:
+        '''Remove all values'''
+        raise NotImplementedError()
+
+
+class LocalCache(CacheBackend):
+    '''An in-process LRU cache bounded by the total size of the stored values'''
+
+    def __init__(self, max_size: int = 256 * 1024 * 1024, default_ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.max_item_size = max_size
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        '''The total size of the stored values, in bytes'''
+        return self._size
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and _now() > expires:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if len(value) > self.max_size:
+            return
+        ttl = ttl if ttl is not None else self.default_ttl
+        expires = _now() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and self._size + len(value) > self.max_size:
+                self._remove(next(iter(self._entries)))
+            self._entries[key] = (expires, value)
+            self._size += len(value)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self._size -= len(value)
+
+
+class FileCache(CacheBackend):
+    '''A cache storing each value in a file, shared between processes on the same host
+
+       Files are written atomically and read via mmap, so all workers share the
+       same pages in the OS page cache. Each file starts with the expiry time as
+       a double, or zero for entries that don't expire.
+
+       The directory is swept regularly: expired files are removed, then the
+       least recently used files until the total size is below max_size. Reads
+       update the modification time of a file to track its use.
+    '''
+    HEADER = struct.Struct("<d")
+    SUFFIX = ".cache"
+    # how often to sweep the directory, in seconds, unless enough was written to need it sooner
+    SWEEP_INTERVAL = 60.
+    # what the total size is reduced to by a sweep, as a fraction of max_size
+    SWEEP_TARGET = 0.9
+
+    def __init__(self, directory: str, default_ttl: Optional[float] = None,
+                 max_size: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self.max_item_size = max_size - self.HEADER.size
+        self._written = 0
+        self._swept = time.monotonic()
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError:
+            # writes will fail and be ignored, behaving like an empty cache
+            pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + self.SUFFIX)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as handle:
+                if os.fstat(handle.fileno()).st_size < self.HEADER.size:
+                    return None
+                with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    expires, = self.HEADER.unpack_from(mapped)
+                    if expires and _now() > expires:
+                        expired = True
+                    else:
+                        expired = False
+                        value = mapped[self.HEADER.size:]
+        except (OSError, ValueError):
+            return None
+        if expired:
+            self.delete(key)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if len(value) + self.HEADER.size > self.max_size:
+            return
+        ttl = ttl if ttl is not None else self.default_ttl
+        expires = _now() + ttl if ttl is not None else 0.
+        temp_path = None
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(handle, "wb") as temp:
+                temp.write(self.HEADER.pack(expires))
+                temp.write(value)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            if temp_path is not None:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+            return
+        self._maybe_sweep(len(value) + self.HEADER.size)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def _entries(self) -> list[os.DirEntry]:
+        try:
+            with os.scandir(self.directory) as entries:
+                return [entry for entry in entries if entry.name.endswith(self.SUFFIX)]
+        except OSError:
+            return []
+
+    def clear(self) -> None:
+        for entry in self._entries():
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+
+    def _maybe_sweep(self, written: int) -> None:
+        with self._lock:
+            self._written += written
+            due = time.monotonic() - self._swept > self.SWEEP_INTERVAL \
+                or self._written > self.max_size * (1 - self.SWEEP_TARGET)
+            if not due:
+                return
+            self._written = 0
+            self._swept = time.monotonic()
+        self.sweep()
+
+    def sweep(self) -> None:
+        '''Remove expired files, then the least recently used ones until below the size limit'''
+        now = _now()
+        remaining = []
+        for entry in self._entries():
+            try:
+                with open(entry.path, "rb") as handle:
+                    header = handle.read(self.HEADER.size)
+                    stat = os.fstat(handle.fileno())
+                if len(header) == self.HEADER.size:
+                    expires, = self.HEADER.unpack(header)
+                    if expires and now > expires:
+                        os.unlink(entry.path)
+                        continue
+                remaining.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in remaining)
+        if total <= self.max_size:
+            return
+        target = self.max_size * self.SWEEP_TARGET
+        for _, size, path in sorted(remaining):
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class SocketCache(CacheBackend):
+    '''A client for a memcached-compatible key-value server on a local socket
+
+       The address is either the path to a unix socket or host:port.
+       Keys are hashed to fit the server's key restrictions.
+    '''
+
+    def __init__(self, address: str, default_ttl: Optional[float] = None, timeout: float = 1.,
+                 max_item_size: int = 1000 * 1000):
+        self.address = address
+        self.default_ttl = default_ttl
+        self.max_item_size = max_item_size
+        self.timeout = timeout
+        self._socket = None
+        self._buffer = b""
+        self._lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        if self._socket is None:
+            if ":" in self.address and not self.address.startswith("/"):
+                host, port = self.address.rsplit(":", 1)
+                sock = socket.create_connection((host, int(port)), timeout=self.timeout)
+            else:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                sock.connect(self.address)
+            self._socket = sock
+            self._buffer = b""
+        return self._socket
+
+    def _disconnect(self) -> None:
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._buffer = b""
+
+    def _read_line(self) -> bytes:
+        while b"\r\n" not in self._buffer:
+            self._fill()
+        line, self._buffer = self._buffer.split(b"\r\n", 1)
+        return line
+
+    def _read_exactly(self, length: int) -> bytes:
+        while len(self._buffer) < length:
+            self._fill()
+        data, self._buffer = self._buffer[:length], self._buffer[length:]
+        return data
+
+    def _fill(self) -> None:
+        chunk = self._socket.recv(65536)
+        if not chunk:
+            raise ConnectionError("cache server closed the connection")
+        self._buffer += chunk
+
+    def _command(self, command: bytes, handler):
+        with self._lock:
+            try:
+                self._connect().sendall(command)
+                return handler()
+            except (OSError, ValueError) as err:
+                current_app.logger.warning("cache server error: %s", err)
+                self._disconnect()
+                return None
+
+    @staticmethod
+    def _key(key: str) -> bytes:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest().encode("ascii")
+
+    def get(self, key: str) -> Optional[bytes]:
+        def handler():
+            header = self._read_line()
+            if header == b"END":
+                return None
+            parts = header.split()
+            if len(parts) < 4 or parts[0] != b"VALUE":
+                raise ValueError(f"unexpected cache response: {header!r}")
+            value = self._read_exactly(int(parts[3]) + 2)[:-2]
+            if self._read_line() != b"END":
+                raise ValueError("unterminated cache response")
+            return value
+        return self._command(b"get " + self._key(key) + b"\r\n", handler)
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        ttl = ttl if ttl is not None else self.default_ttl
+        header = b"set %s 0 %d %d\r\n" % (self._key(key), int(ttl or 0), len(value))
+        # a failure to store, e.g. for values that are too large, is just a cache miss later on
+        self._command(header + value + b"\r\n", self._read_line)
+
+    def delete(self, key: str) -> None:
+        self._command(b"delete " + self._key(key) + b"\r\n", self._read_line)
+
+    def clear(self) -> None:
+        self._command(b"flush_all\r\n", self._read_line)
+
+
+BACKENDS = {
+    'local': lambda config: LocalCache(config.get('CACHE_MAX_SIZE', 256 * 1024 * 1024),
+                                       config.get('CACHE_TTL')),
+    'filesystem': lambda config: FileCache(config['CACHE_DIR'], config.get('CACHE_TTL'),
+                                           config.get('CACHE_MAX_SIZE', 1024 * 1024 * 1024)),
+    'socket': lambda config: SocketCache(config['CACHE_SOCKET'], config.get('CACHE_TTL'),
+                                         max_item_size=config.get('CACHE_MAX_ITEM_SIZE', 1000 * 1000)),
+}
+
+_BACKEND = None
+_VERSION = {'checked': None, 'value': None}
+
+
+def get_cache() -> CacheBackend:
+    '''Get the cache backend for this process, as selected by the app configuration'''
+    global _BACKEND
+    if _BACKEND is None:
+        name = current_app.config.get('CACHE_BACKEND', 'local')
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown cache backend: {name!r}")
+        _BACKEND = BACKENDS[name](current_app.config)
+    return _BACKEND
+
+
+def database_version() -> str:
+    '''Get a fingerprint of the database contents
+
+       The fingerprint changes when the database is reloaded with new genomes.
+       It is only recalculated every DB_VERSION_CHECK_INTERVAL seconds.
+    '''
+    interval = current_app.config.get('DB_VERSION_CHECK_INTERVAL', 60)
+    checked = _VERSION['checked']
+    if checked is None or time.monotonic() - checked > interval:
+        count, latest = db.session.query(func.count(Genome.genome_id), func.max(Genome.genome_id)).one()
+        _VERSION['value'] = f"{count}-{latest}"
+        _VERSION['checked'] = time.monotonic()
+    return _VERSION['value']
+
+
+def make_key(prefix: str, *args) -> str:
+    '''Build a cache key for the arguments, specific to the current database contents'''
+    return json.dumps([prefix, database_version(), args], sort_keys=True, separators=(',', ':'))
+
+
+def memoise(prefix: str, ttl: Optional[float] = None):
+    '''Decorator caching the JSON-serialisable results of a function by its arguments'''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args):
+            key = make_key(prefix, *args)
+            cache = get_cache()
+            cached = cache.get(key)
+            if cached is not None:
+                return json.loads(cached)
+            result = function(*args)
+            cache.set(key, json.dumps(result).encode("utf-8"), ttl)
+            return result
+        return wrapper
+    return decorator
+
+
+# the time a payload was built and the SHA-1 digest of the payload, for ETags
+PAYLOAD_HEADER = struct.Struct("<d20s")
+
+
+def cached_payload(prefix: str, builder, refresh: bool = False, args: tuple = ()) -> tuple[bytes, float, str]:
+    '''Get a pre-serialised payload from the cache, building it on a miss
+
+       The builder is called with the given arguments, which are also part of
+       the cache key, and must return bytes. The payload is rebuilt when the
+       database contents change or when refresh is set. The payload's digest
+       is calculated once when it's built and stored with it.
+
+       Returns a tuple of the payload, the time it was built and its hex digest.
+    '''
+    # the header format is part of the key, so payloads cached with older headers are never read
+    key = make_key(prefix, PAYLOAD_HEADER.format, *args)
+    cache = get_cache()
+    blob = None if refresh else cache.get(key)
+    if blob is None or len(blob) < PAYLOAD_HEADER.size:
+        payload = builder(*args)
+        blob = PAYLOAD_HEADER.pack(_now(), hashlib.sha1(payload).digest()) + payload
+        cache.set(key, blob)
+    built, digest = PAYLOAD_HEADER.unpack_from(blob)
+    return blob[PAYLOAD_HEADER.size:], built, digest.hex()
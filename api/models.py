@@ -265,6 +265,8 @@ class DnaSequence(db.Model):
     record_number = db.Column(db.Integer)
     version = db.Column(db.Integer)
     genome_id = db.Column(db.ForeignKey('antismash.genomes.genome_id', ondelete='CASCADE'))
+    # whole records can be megabases long, so they're only loaded when explicitly selected
+    dna = db.deferred(db.Column(db.Text))
 
     genome = db.relationship('Genome', primaryjoin='DnaSequence.genome_id == Genome.genome_id', backref='dna_sequences')
 
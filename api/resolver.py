@@ -0,0 +1,114 @@
+'''In-memory resolution of assembly ids and record accessions for the goto redirects
+
+Identifiers are resolved like the case-insensitive prefix matches of the
+database: an identifier resolves to the first assembly id it is a prefix of,
+otherwise to the assembly of the first record accession it is a prefix of.
+The lowercased keys are kept in sorted arrays and matched by binary search.
+Accessions are by far the most numerous, so they are packed into a single
+bytes object instead of a list of strings.
+'''
+
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+import threading
+from typing import Iterable, Optional
+
+from .cache import database_version
+from .models import (
+    db,
+    DnaSequence,
+    Filename,
+    Genome,
+)
+
+
+class PackedStrings:
+    '''An immutable sequence of ASCII strings, packed into a single bytes object'''
+
+    def __init__(self, strings: Iterable[str]) -> None:
+        encoded = [string.encode('ascii', errors='replace') for string in strings]
+        self._data = b''.join(encoded)
+        self._offsets = array('q', accumulate((len(string) for string in encoded), initial=0))
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._data[self._offsets[index]:self._offsets[index + 1]].decode('ascii')
+
+
+def _first_with_prefix(keys, prefix: str) -> Optional[int]:
+    index = bisect_left(keys, prefix)
+    if index < len(keys) and keys[index].startswith(prefix):
+        return index
+    return None
+
+
+class IdentifierResolver:
+    '''Prefix lookups of assembly ids and accessions'''
+
+    def __init__(self, assemblies: Iterable[Optional[str]], records: Iterable[tuple[str, Optional[str]]],
+                 filenames: Iterable[tuple[str, str]]) -> None:
+        self.assemblies = sorted({assembly for assembly in assemblies if assembly}, key=str.lower)
+        self._assembly_keys = [assembly.lower() for assembly in self.assemblies]
+        positions = {assembly: index for index, assembly in enumerate(self.assemblies)}
+
+        records = sorted((accession.lower(), positions[assembly]) for accession, assembly in records
+                         if accession and assembly in positions)
+        self._accession_keys = PackedStrings(accession for accession, _ in records)
+        self._accession_assemblies = array('l', (assembly for _, assembly in records))
+        self.filenames = dict(filenames)
+
+    def resolve(self, identifier: str) -> Optional[str]:
+        '''Find the assembly id for an assembly id or accession, or a prefix of either'''
+        prefix = identifier.lower()
+        index = _first_with_prefix(self._assembly_keys, prefix)
+        if index is not None:
+            return self.assemblies[index]
+        index = _first_with_prefix(self._accession_keys, prefix)
+        if index is not None:
+            return self.assemblies[self._accession_assemblies[index]]
+        return None
+
+    def base_filename(self, assembly_id: str) -> Optional[str]:
+        '''Find the base name of the result files of an assembly'''
+        return self.filenames.get(assembly_id)
+
+
+# the current (version, resolver) pair, always replaced as a whole
+_RESOLVER = {'current': (None, None)}
+_BUILD_LOCK = threading.Lock()
+
+
+def build_resolver() -> IdentifierResolver:
+    '''Build a new identifier resolver from the database'''
+    assemblies = db.session.query(Genome.assembly_id)
+    records = db.session.query(DnaSequence.accession, Genome.assembly_id).join(Genome, DnaSequence.genome).yield_per(10000)
+    filenames = db.session.query(Filename.assembly_id, Filename.base_filename)
+    return IdentifierResolver((row.assembly_id for row in assemblies), records, filenames)
+
+
+def get_resolver() -> IdentifierResolver:
+    '''Get the identifier resolver for the current database contents
+
+       The resolver is built by a single request at a time, without holding up
+       other requests: while it is rebuilt after the database contents
+       changed, other requests keep using the previous one. Only the very
+       first requests of a worker wait for it to be built.
+    '''
+    version = database_version()
+    built_version, resolver = _RESOLVER['current']
+    if resolver is not None and built_version == version:
+        return resolver
+    if _BUILD_LOCK.acquire(blocking=resolver is None):
+        try:
+            built_version, resolver = _RESOLVER['current']
+            if resolver is None or built_version != version:
+                resolver = build_resolver()
+                _RESOLVER['current'] = (version, resolver)
+        finally:
+            _BUILD_LOCK.release()
+    return resolver
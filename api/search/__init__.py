@@ -1,32 +1,62 @@
 '''Search-related functions'''
+from array import array
+import base64
+import binascii
+from bisect import bisect_right
+import hashlib
+import json
+
+from flask import current_app
 from sqlalchemy import (
     func,
+    select,
+    text,
 )
+from sqlalchemy.exc import OperationalError
+from api.cache import get_cache, make_key, memoise
 from api.models import (
     db,
     AsDomain,
-    BgcType,
     Cds,
-    DnaSequence,
-    Genome,
     Region,
-    Taxa,
-    t_rel_regions_types,
 )
+from api.search_parser import QueryOperand
 from .clusters import (
+    explain,
+    cluster_ids_from_term,
     cluster_query_from_term,
     CLUSTER_FORMATTERS,
 )
 from .genes import (
+    gene_ids_from_term,
     gene_query_from_term,
     GENE_FORMATTERS,
 )
 from .domains import (
+    domain_ids_from_term,
     domain_query_from_term,
     DOMAIN_FORMATTERS,
 )
 
-from .helpers import UnknownQueryError
+from .facets import (
+    DEFAULT_FACETS,
+    facet_counts,
+    region_id_select,
+)
+from .helpers import (
+    id_filter,
+    InvalidQueryError,
+    UnknownQueryError,
+)
+from .optimiser import optimise
+from .result_cache import (
+    cache_key,
+    get_cached_ids,
+    get_oversized_total,
+    result_cache_enabled,
+    set_cached_ids,
+    set_oversized_total,
+)
 
 #######
 # The following imports are just so the code depending on search doesn't need changes
@@ -40,6 +70,19 @@ FORMATTERS = {
 }
 
 
+ID_QUERIES = {
+    'cluster': cluster_ids_from_term,
+    'gene': gene_ids_from_term,
+    'domain': domain_ids_from_term,
+}
+
+SEARCH_KEYS = {
+    'cluster': (Region, Region.region_id),
+    'gene': (Cds, Cds.cds_id),
+    'domain': (AsDomain, AsDomain.as_domain_id),
+}
+
+
 class NoneQuery(object):
     '''A 'no result' return object'''
     def all(self):
@@ -47,24 +90,324 @@ class NoneQuery(object):
         return []
 
 
-def core_search(query):
-    '''Actually run the search logic'''
-    sql_query = NoneQuery()
+def _search_key(query):
+    '''Get the model and primary key column for the query's search type'''
+    if query.search_type not in SEARCH_KEYS:
+        raise UnknownQueryError()
+    return SEARCH_KEYS[query.search_type]
+
+
+def _operand_ids(search_type, operand):
+    '''Build the id-only SQL SELECT for a single search operand, given as JSON'''
+    if search_type not in ID_QUERIES:
+        raise UnknownQueryError()
+    return ID_QUERIES[search_type](QueryOperand.from_json(operand))
+
+
+def _planned_rows(statement):
+    '''Get the query planner's estimate of the number of rows of a statement'''
+    plan = db.session.execute(explain(statement, json=True)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+@memoise('search.estimate')
+def operand_estimate(search_type, operand):
+    '''Get the query planner's estimate of the results of a single search operand, given as JSON
+
+       Estimates are never zero, so an operand is only ever treated as empty
+       once its exact count is known.
+    '''
+    return max(_planned_rows(_operand_ids(search_type, operand)), 1)
+
+
+def known_cardinality(search_type, operand):
+    '''Get the exact number of results of a single search operand, if already cached'''
+    cached = get_cache().get(make_key('search.cardinality', search_type, operand))
+    if cached is None:
+        return None
+    return json.loads(cached)
+
+
+def remember_cardinality(query, count):
+    '''Cache the exact number of results of a single operand query, for later optimisations'''
+    if query.terms.kind != 'expression':
+        return
+    key = make_key('search.cardinality', query.search_type, query.terms.to_json())
+    get_cache().set(key, json.dumps(count).encode('utf-8'))
 
+
+def operand_cardinality(search_type, operand):
+    '''Get the number of results of a single search operand, given as JSON
+
+       Exact counts are only used if an earlier search already cached them,
+       otherwise the cheap planner estimate is used.
+    '''
+    known = known_cardinality(search_type, operand)
+    if known is not None:
+        return known
+    return operand_estimate(search_type, operand)
+
+
+def _terms(query):
+    '''Get the search terms of the query, optimised unless disabled'''
+    if not current_app.config.get('SEARCH_OPTIMISER', True):
+        return query.terms
+    return optimise(query.terms, lambda operand: operand_cardinality(query.search_type, operand.to_json()))
+
+
+def _query_from_term(query):
+    '''Build the unordered SQL query for the search terms'''
     if query.search_type == 'cluster':
-        sql_query = cluster_query_from_term(query.terms).order_by(Region.region_id)
-    elif query.search_type == 'gene':
-        sql_query = gene_query_from_term(query.terms).order_by(Cds.cds_id)
-    elif query.search_type == 'domain':
-        sql_query = domain_query_from_term(query.terms).order_by(AsDomain.as_domain_id)
-    else:
+        return cluster_query_from_term(_terms(query))
+    if query.search_type == 'gene':
+        return gene_query_from_term(_terms(query))
+    if query.search_type == 'domain':
+        return domain_query_from_term(_terms(query))
+    raise UnknownQueryError()
+
+
+def _ids_from_term(query, optimised=True):
+    '''Build the unordered, id-only SQL SELECT for the search terms'''
+    if query.search_type not in ID_QUERIES:
         raise UnknownQueryError()
+    return ID_QUERIES[query.search_type](_terms(query) if optimised else query.terms)
+
+
+def _stream(sql_query, batch_size=None):
+    '''Iterate over the rows of a query via a server-side cursor, fetching batch_size rows at a time
+
+       The batch size defaults to the SEARCH_STREAM_BATCH_SIZE config option.
+    '''
+    if batch_size is None:
+        batch_size = current_app.config['SEARCH_STREAM_BATCH_SIZE']
+    return iter(sql_query.yield_per(batch_size))
+
+
+def core_search(query, stream=False, batch_size=None, ids_only=False):
+    '''Actually run the search logic
+
+       By default all results are loaded into a list. With stream set, an
+       iterator is returned instead, which fetches the results from a
+       server-side cursor in batches of batch_size.
+       With ids_only set, only the distinct primary keys of the results are
+       selected and returned as integers, without loading any entities.
+    '''
+    _, key = _search_key(query)
+    if ids_only:
+        rows = _stream(id_query(query), batch_size)
+        ids = (row[0] for row in rows)
+        return ids if stream else list(ids)
+
+    sql_query = _query_from_term(query).order_by(key)
+
+    if stream:
+        return _stream(sql_query, batch_size)
 
     results = sql_query.all()
 
     return results
 
 
+def id_query(query, optimised=True):
+    '''Get an SQL query for the distinct, ordered primary keys of the search results
+
+       The ids are labelled with the name of the primary key column, e.g. region_id.
+       If optimised is not set, the query tree is used as is, without
+       estimating the results of its operands first.
+    '''
+    _, key = _search_key(query)
+    ids = _ids_from_term(query, optimised).subquery()
+    column = ids.c[key.key]
+    return db.session.query(column).distinct().order_by(column)
+
+
+def count_results(query):
+    '''Count the search results in the database without loading them'''
+    ids = id_query(query).order_by(None).subquery()
+    total = db.session.query(func.count()).select_from(ids).scalar()
+    remember_cardinality(query, total)
+    return total
+
+
+def estimate_results(query):
+    '''Get the query planner's estimate of the number of search results, without running the search'''
+    return _planned_rows(id_query(query, optimised=False).order_by(None).statement)
+
+
+def count_results_within(query, timeout):
+    '''Count the search results exactly, unless that takes longer than timeout milliseconds
+
+       Returns None if the count was cancelled.
+    '''
+    if result_cache_enabled():
+        key = cache_key(query)
+        ids = get_cached_ids(key)
+        if ids is not None:
+            return len(ids)
+        total = get_oversized_total(key)
+        if total is not None:
+            return total
+    try:
+        with db.session.begin_nested():
+            db.session.execute(text('SET LOCAL statement_timeout = {:d}'.format(int(timeout))))
+            total = count_results(query)
+            db.session.execute(text('SET LOCAL statement_timeout TO DEFAULT'))
+    except OperationalError:
+        return None
+    return total
+
+
+def load_results(query, ids):
+    '''Load the result entities for the given primary keys, in primary key order'''
+    model, key = _search_key(query)
+    ids = list(ids)
+    if not ids:
+        return []
+    return model.query.filter(id_filter(key, ids)).order_by(key).all()
+
+
+def _cache_ids(query, key, ids):
+    '''Cache the complete result ids of a query, or mark them as too many to cache'''
+    remember_cardinality(query, len(ids))
+    if set_cached_ids(key, ids):
+        return True
+    set_oversized_total(key, len(ids))
+    return False
+
+
+def result_ids(query):
+    '''Get the ordered primary keys of all search results as a compact array
+
+       The ids of recent searches are cached, so repeated requests for stats or
+       exports of the same query don't run the search again.
+    '''
+    if not result_cache_enabled():
+        return array('q', core_search(query, stream=True, ids_only=True))
+
+    key = cache_key(query)
+    ids = get_cached_ids(key)
+    if ids is None:
+        ids = array('q', core_search(query, stream=True, ids_only=True))
+        _cache_ids(query, key, ids)
+    return ids
+
+
+def cached_result_ids(query):
+    '''Get the ordered primary keys of the search results, if they can be cached
+
+       Returns a tuple of the ids and the total number of results. If there are
+       too many results to cache, the ids are None and the results are only
+       counted. A search is fetched at most up to the cache limit to find out,
+       and the total is cached with the oversized mark, so later requests skip
+       the fetch. If the result cache is disabled, both are None.
+    '''
+    if not result_cache_enabled():
+        return None, None
+
+    key = cache_key(query)
+    ids = get_cached_ids(key)
+    if ids is not None:
+        return ids, len(ids)
+    total = get_oversized_total(key)
+    if total is not None:
+        return None, total
+
+    limit = current_app.config.get('RESULT_CACHE_MAX_IDS', 0)
+    ids = array('q', (row[0] for row in _stream(id_query(query).limit(limit + 1))))
+    if len(ids) <= limit:
+        if _cache_ids(query, key, ids):
+            return ids, len(ids)
+        return None, len(ids)
+    total = count_results(query)
+    set_oversized_total(key, total)
+    return None, total
+
+
+def result_count(query):
+    '''Count the search results, using the result cache where possible'''
+    _, total = cached_result_ids(query)
+    if total is None:
+        total = count_results(query)
+    return total
+
+
+def paginated_search(query, offset=0, paginate=0, after=None):
+    '''Run the search logic for a single page of results
+
+       If after is given, the page starts with the first result with a primary
+       key greater than after and the offset is ignored. A paginate value of
+       zero or less returns all remaining results. Only the entities on the page
+       are loaded from the database.
+
+       When the result ids are cached, the page is sliced from them, otherwise
+       the page is selected by LIMIT/OFFSET or by key on the result ids in the
+       database, so the cost of a page doesn't grow with the number of results.
+
+       Returns a tuple of the total number of results and the page of results.
+    '''
+    ids, total = cached_result_ids(query)
+    if ids is not None:
+        start = max(offset, 0) if after is None else bisect_right(ids, after)
+        end = len(ids) if paginate <= 0 else start + paginate
+        return total, load_results(query, ids[start:end])
+
+    if total is None:
+        total = count_results(query)
+    if after is None:
+        page = id_query(query).offset(max(offset, 0))
+    else:
+        _, key = _search_key(query)
+        ids = id_query(query).order_by(None).subquery()
+        column = ids.c[key.key]
+        page = db.session.query(column).filter(column > after).order_by(column)
+    if paginate > 0:
+        page = page.limit(paginate)
+    results = load_results(query, [row[0] for row in page])
+    return total, results
+
+
+def _query_hash(query):
+    '''Get a short, stable hash of the search type and terms of a query'''
+    canonical = json.dumps([query.search_type, query.terms.to_json()], sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+def encode_cursor(query, last_id):
+    '''Build an opaque cursor token to continue the search after the given id'''
+    payload = json.dumps({'q': _query_hash(query), 'last': last_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(query, token):
+    '''Get the last id seen from a cursor token built by encode_cursor
+
+       An empty token starts at the beginning of the results and returns None.
+       Raises an InvalidQueryError if the token is malformed or was built for a
+       different query.
+    '''
+    if not token:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        query_hash = payload['q']
+        last_id = int(payload['last'])
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError, UnicodeError):
+        raise InvalidQueryError("Invalid cursor")
+    if query_hash != _query_hash(query):
+        raise InvalidQueryError("Cursor does not match query")
+    return last_id
+
+
+def next_cursor(query, results, paginate):
+    '''Get the cursor token for the page after the given results, if there may be one'''
+    if paginate <= 0 or len(results) < paginate:
+        return None
+    _, key = _search_key(query)
+    return encode_cursor(query, getattr(results[-1], key.key))
+
+
 def format_results(query, results):
     '''Get the appropriate formatter for the query'''
     try:
@@ -74,29 +417,33 @@ def format_results(query, results):
         return []
 
 
-def region_stats(regions):
-    '''Calculate stats on the search results'''
-    stats = {}
+def format_results_batched(query, ids, batch_size=1000):
+    '''Load and format the results for the ids in batches, yielding the formatted batches
 
-    if len(regions) < 1:
-        return stats
+       Only one batch of entities is loaded at a time, so memory use doesn't
+       depend on the number of results.
+    '''
+    if not len(ids):
+        yield format_results(query, [])
+        return
+    for start in range(0, len(ids), batch_size):
+        yield format_results(query, load_results(query, ids[start:start + batch_size]))
 
-    bgc_ids = set(map(lambda x: x.region_id, regions))
 
-    clusters_by_type_list = db.session.query(BgcType.term, func.count(BgcType.term)) \
-                                      .join(t_rel_regions_types).join(Region) \
-                                      .filter(Region.region_id.in_(bgc_ids)).group_by(BgcType.term).order_by(BgcType.term).all()
-    clusters_by_type = {}
-    if clusters_by_type_list is not None:
-        clusters_by_type['labels'], clusters_by_type['data'] = zip(*clusters_by_type_list)
-    stats['clusters_by_type'] = clusters_by_type
+def region_stats(query, facets=DEFAULT_FACETS):
+    '''Calculate stats on the regions of the search results
 
-    clusters_by_phylum_list = db.session.query(Taxa.phylum, func.count(Taxa.phylum)) \
-                                        .join(Genome).join(DnaSequence).join(Region) \
-                                        .filter(Region.region_id.in_(bgc_ids)).group_by(Taxa.phylum).all()
-    clusters_by_phylum = {}
-    if clusters_by_phylum_list is not None:
-        clusters_by_phylum['labels'], clusters_by_phylum['data'] = zip(*clusters_by_phylum_list)
-    stats['clusters_by_phylum'] = clusters_by_phylum
-
-    return stats
+       All facets are counted in a single query over the search's own ids,
+       taken from the result cache if they're cached, otherwise selected by
+       the search SQL as part of the query.
+    '''
+    ids = None
+    if result_cache_enabled():
+        ids = get_cached_ids(cache_key(query))
+    if ids is None:
+        ids = id_query(query).order_by(None).subquery()
+    else:
+        _, key = _search_key(query)
+        ids = select(key.label(key.key)).where(id_filter(key, ids)).subquery()
+    counts = facet_counts(region_id_select(query.search_type, ids), facets)
+    return {'clusters_by_{}'.format(name): facet for name, facet in counts.items()}
@@ -1,8 +1,14 @@
 '''Available terms by category searches
 
 This is used for the web UI for typeahead opetions
+
+Categories that only match a single column by prefix are answered from sorted
+in-memory vocabularies, the others run a query.
 '''
 
+from bisect import bisect_left
+import threading
+
 from sqlalchemy import (
     distinct,
     null,
@@ -14,6 +20,9 @@ from .helpers import (
     sanitise_string,
 )
 
+from api.cache import database_version, memoise
+from api.resolver import PackedStrings
+
 from api.models import (
     db,
     AsDomain,
@@ -44,6 +53,77 @@ from api.models import (
 )
 
 AVAILABLE = {}
+TYPEAHEAD_LIMIT = 50
+
+
+class PrefixIndex:
+    '''A sorted vocabulary answering case-insensitive prefix lookups
+
+       Large ASCII vocabularies like accessions can be packed into single bytes
+       objects instead of lists of strings.
+    '''
+
+    def __init__(self, values, packed=False):
+        values = sorted({value for value in values if value is not None},
+                        key=lambda value: (value.lower(), value))
+        keys = [value.lower() for value in values]
+        if packed:
+            values, keys = PackedStrings(values), PackedStrings(keys)
+        self.values = values
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.values)
+
+    def lookup(self, prefix, limit=TYPEAHEAD_LIMIT):
+        '''Get up to limit values starting with the prefix, in sorted order'''
+        prefix = prefix.lower()
+        start = bisect_left(self.keys, prefix)
+        end = min(start + limit, len(self.keys))
+        matches = []
+        for i in range(start, end):
+            if not self.keys[i].startswith(prefix):
+                break
+            matches.append(self.values[i])
+        return matches
+
+
+# categories matching a single column by prefix, with whether the value is also the description
+PREFIX_CATEGORIES = {
+    'superkingdom': (Taxa.superkingdom, False),
+    'phylum': (Taxa.phylum, False),
+    'class': (Taxa._class, False),
+    'order': (Taxa.taxonomic_order, False),
+    'family': (Taxa.family, False),
+    'genus': (Taxa.genus, False),
+    'species': (Taxa.species, False),
+    'strain': (Taxa.strain, False),
+    'acc': (DnaSequence.accession, False),
+    'assembly': (Genome.assembly_id, False),
+    'compoundseq': (Ripp.peptide_sequence, False),
+    'compoundclass': (Ripp.subclass, False),
+    'asdomainsubtype': (AsDomainSubtype.subtype, True),
+    'functionalclass': (FunctionalClass.name, True),
+    'terpenedomain': (TerpeneDomain.name, True),
+}
+# by far the largest vocabularies, kept packed
+PACKED_CATEGORIES = {'acc', 'assembly'}
+
+_PREFIX_INDEXES = {}
+_PREFIX_LOCK = threading.Lock()
+
+
+def get_prefix_index(category):
+    '''Get the vocabulary of a prefix category, loading it if missing or outdated'''
+    version = database_version()
+    with _PREFIX_LOCK:
+        cached = _PREFIX_INDEXES.get(category)
+        if cached is None or cached[0] != version:
+            column, _ = PREFIX_CATEGORIES[category]
+            values = db.session.query(distinct(column))
+            cached = (version, PrefixIndex((row[0] for row in values), packed=category in PACKED_CATEGORIES))
+            _PREFIX_INDEXES[category] = cached
+        return cached[1]
 
 
 def available_term_by_category(category, term):
@@ -51,13 +131,25 @@ def available_term_by_category(category, term):
     cleaned_category = sanitise_string(category)
     cleaned_term = sanitise_string(term)
 
+    if cleaned_category in PREFIX_CATEGORIES:
+        _, described = PREFIX_CATEGORIES[cleaned_category]
+        # the vocabularies are matched literally, so the ILIKE escaping doesn't apply
+        values = get_prefix_index(cleaned_category).lookup(term)
+        return [{'val': value, 'desc': value if described else None} for value in values]
+
     if cleaned_category in AVAILABLE:
-        query = AVAILABLE[cleaned_category](cleaned_term).limit(50)
-        return list(map(lambda x: {'val': x[0], 'desc': x[1]}, query.all()))
+        return _available_terms(cleaned_category, cleaned_term)
 
     return []
 
 
+@memoise('available')
+def _available_terms(category, term):
+    '''Run the typeahead query for a known category'''
+    query = AVAILABLE[category](term).limit(TYPEAHEAD_LIMIT)
+    return list(map(lambda x: {'val': x[0], 'desc': x[1]}, query.all()))
+
+
 class FakeBooleanQuery:
     """Fake Query class to return boolean value typeaheads."""
     def __init__(self, term, true_help, false_help):
@@ -12,6 +12,10 @@ from sqlalchemy import (
 from sqlalchemy.orm import joinedload
 from .helpers import (
     break_lines,
+    entities_from_ids,
+    fetch_slices,
+    id_filter,
+    ids_from_term,
     register_handler as _register_handler,
     UnknownQueryError,
 )
@@ -98,16 +102,22 @@ register_countable_handler = partial(_register_handler, countable=True, counter=
 class explain(Executable, ClauseElement):
     inherit_cache = False
 
-    def __init__(self, stmt, analyze=False):
+    def __init__(self, stmt, analyze=False, json=False):
         self.statement = stmt
         self.analyze = analyze
+        self.json = json
 
 
 @compiles(explain, 'postgresql')
 def pg_explain(element, compiler, **kw):
+    options = []
+    if element.analyze:
+        options.append("ANALYZE")
+    if element.json:
+        options.append("FORMAT JSON")
     text = "EXPLAIN "
-    if element.analyse:
-        text += "ANALYZE "
+    if options:
+        text += "({}) ".format(", ".join(options))
     text += compiler.process(element.statement, **kw)
     compiler.isinsert = compiler.isupdate = compiler.isdelete = False
 
@@ -117,10 +127,13 @@ def pg_explain(element, compiler, **kw):
 @register_handler(CLUSTER_FORMATTERS)
 def clusters_to_json(clusters):
     '''Convert model.BiosyntheticGeneClusters into JSON'''
-    query = db.session.query(Region, Genome.assembly_id, DnaSequence.accession, DnaSequence.version, DnaSequence.record_number, Taxa.genus, Taxa.species, Taxa.strain)
-    query = query.options(joinedload(Region.bgc_types)).options(joinedload(Region.clusterblast_hits))
+    query = db.session.query(Region, Genome.assembly_id, DnaSequence.accession, DnaSequence.version, DnaSequence.record_number, Taxa.genus, Taxa.species, Taxa.strain,
+                             NbcCollection.identifier.label('nbc'), NpdcCollection.identifier.label('npdc'), DsmzCollection.identifier.label('dsmz'))
+    query = query.options(joinedload(Region.bgc_types)).options(joinedload(Region.clusterblast_hits).joinedload(ClusterblastHit.algorithm))
     query = query.join(DnaSequence, Region.dna_sequence).join(Genome, DnaSequence.genome).join(Taxa, Genome.tax)
-    query = query.filter(Region.region_id.in_(map(lambda x: x.region_id, clusters)))
+    query = query.outerjoin(NbcCollection, Genome.nbc_collection).outerjoin(NpdcCollection, Genome.npdc_collection) \
+                 .outerjoin(DsmzCollection, Genome.dsmz_collection)
+    query = query.filter(id_filter(Region.region_id, map(lambda x: x.region_id, clusters)))
     query = query.order_by(Region.region_id)
 
     json_clusters = []
@@ -168,9 +181,9 @@ def clusters_to_json(clusters):
         json_cluster['contig_edge'] = cluster.Region.contig_edge
         json_cluster['cross_origin'] = cluster.Region.start_pos > cluster.Region.end_pos
         json_cluster["strain_collection"] = {
-            "nbc": cluster.Region.dna_sequence.genome.nbc_collection.identifier if cluster.Region.dna_sequence.genome.nbc_collection else None,
-            "npdc": cluster.Region.dna_sequence.genome.npdc_collection.identifier if cluster.Region.dna_sequence.genome.npdc_collection else None,
-            "dsmz": cluster.Region.dna_sequence.genome.dsmz_collection.identifier if cluster.Region.dna_sequence.genome.dsmz_collection else None
+            "nbc": cluster.nbc,
+            "npdc": cluster.npdc,
+            "dsmz": cluster.dsmz,
         }
 
         json_clusters.append(json_cluster)
@@ -195,15 +208,16 @@ def clusters_to_fasta(clusters):
     '''Convert model.BiosyntheticGeneCluster into FASTA'''
     query = db.session.query(Region, DnaSequence.accession, DnaSequence.version,
                              Taxa.tax_id, Taxa.genus, Taxa.species, Taxa.strain)
-    query = query.options(joinedload('bgc_types'))
-    query = query.join(DnaSequence).join(Genome).join(Taxa)
-    query = query.filter(Region.region_id.in_(map(lambda x: x.region_id, clusters))).order_by(Region.region_id)
+    query = query.options(joinedload(Region.bgc_types))
+    query = query.join(DnaSequence, Region.dna_sequence).join(Genome).join(Taxa)
+    query = query.filter(id_filter(Region.region_id, map(lambda x: x.region_id, clusters))).order_by(Region.region_id)
     search = ''
     if g.verbose:
         search = "|{}".format(g.search_str)
-    for cluster in query:
-        location = location_from_string(cluster.Region.location)
-        seq = break_lines(cluster.Region.dna_sequence.dna[location.start+1:location.end])
+    rows = [(cluster, location_from_string(cluster.Region.location)) for cluster in query]
+    sequences = fetch_slices((cluster.accession, location.start + 1, location.end) for cluster, location in rows)
+    for (cluster, location), sequence in zip(rows, sequences):
+        seq = break_lines(sequence)
         compiled_type = ' - '.join(sorted([t.term for t in cluster.Region.bgc_types], key=str.casefold))
         fasta = '>{c.accession}.{c.version}|{location.start}-{location.end}|' \
                 '{compiled_type}|' \
@@ -213,32 +227,33 @@ def clusters_to_fasta(clusters):
         yield fasta
 
 
-def cluster_query_from_term(term):
-    '''Recursively generate an SQL query from the search terms'''
-    if term.kind == 'expression':
-        if term.category == 'unknown':
-            raise ValueError("Unknown category in query")
-        if term.category in CLUSTERS:
-            handler = CLUSTERS[term.category]
-            query = handler(term.term)
-            for query_filter in term.filters:
-                query = query_filter.runner.run(query, query_filter.get_options())
-            query = handler.add_count_restriction(query, term.count)
-            return query
-        else:
-            raise UnknownQueryError()
-    elif term.kind == 'operation':
-        left_query = cluster_query_from_term(term.left)
-        right_query = cluster_query_from_term(term.right)
-        if term.operator == 'except':
-            return left_query.except_(right_query)
-        elif term.operator == 'or':
-            return left_query.union(right_query)
-        elif term.operator == 'and':
-            return left_query.intersect(right_query)
+def _cluster_operand_query(term):
+    '''Generate an SQL query for a single search expression'''
+    if term.category == 'unknown':
+        raise ValueError("Unknown category in query")
+    if term.category not in CLUSTERS:
         raise UnknownQueryError()
+    handler = CLUSTERS[term.category]
+    query = handler(term.term)
+    for query_filter in term.filters:
+        query = query_filter.runner.run(query, query_filter.get_options())
+    return handler.add_count_restriction(query, term.count)
+
 
-    raise UnknownQueryError()
+def cluster_ids_from_term(term):
+    '''Generate an SQL SELECT of the ids of the regions matching the search terms'''
+    return ids_from_term(term, _cluster_operand_query, Region.region_id)
+
+
+def cluster_query_from_term(term):
+    '''Recursively generate an SQL query from the search terms
+
+       Operations are run on the region ids only, the regions are joined back
+       to the combined ids at the end.
+    '''
+    if term.kind == 'expression':
+        return _cluster_operand_query(term)
+    return entities_from_ids(Region, Region.region_id, cluster_ids_from_term(term))
 
 
 @register_countable_handler(CLUSTERS, description="BGC type as predicted by antiSMASH")
@@ -554,12 +569,12 @@ def clusters_by_modulequery(term):
                 assert operator is None, query_part
                 # filter by other previous sections' constraints, if they exist
                 if absolute_modules:
-                    current_query.filter(Module.module_id.in_(absolute_modules))
+                    current_query = current_query.filter(id_filter(Module.module_id, absolute_modules))
                 return current_query
 
             # following parts of the section must all have things that matched the earlier parts
             assert section_modules is not None, query_part
-            return current_query.filter(Module.module_id.in_(section_modules))
+            return current_query.filter(id_filter(Module.module_id, section_modules))
 
         assert operator != module_query.IGNORE, query_part
 
@@ -604,11 +619,11 @@ def clusters_by_modulequery(term):
             prev_domains = AsDomain.query.with_entities(AsDomain.as_domain_id).join(AsDomainProfile)
             # restrict to previous ids in case of chained THEN
             if previous_part.operator == module_query.THEN:
-                prev_domains = prev_domains.filter(AsDomain.as_domain_id.in_(previous_part.matching_domain_ids))
+                prev_domains = prev_domains.filter(id_filter(AsDomain.as_domain_id, previous_part.matching_domain_ids))
 
             if previous_part.value != module_query.ANY:
                 prev_domains = prev_domains.filter(AsDomainProfile.name == previous_part.value)
-            matches = matches.filter(AsDomain.follows.in_({i[0] for i in prev_domains.all()}))
+            matches = matches.filter(id_filter(AsDomain.follows, {i[0] for i in prev_domains.all()}))
         all_matches = list(matches.all())
         query_part.matching_domain_ids = {i[1] for i in all_matches}
         module_ids = {i[0] for i in all_matches}
@@ -665,7 +680,7 @@ def clusters_by_modulequery(term):
     # in the case where all options are ANY, no results are generated yet
     if matching_modules is None:
         raise InvalidQueryError("no restrictions in query: %s" % term)
-    return Region.query.join(Module).filter(Module.module_id.in_(matching_modules)).distinct(Region.region_id)
+    return Region.query.join(Module).filter(id_filter(Module.module_id, matching_modules)).distinct(Region.region_id)
 
 
 @register_countable_handler(CLUSTERS, description="Regions containing a cross-CDS module")
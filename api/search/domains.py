@@ -5,9 +5,13 @@ from flask import g
 from sqlalchemy import (
     sql,
 )
+from sqlalchemy.orm import contains_eager
 from .helpers import (
     break_lines,
-    calculate_sequence,
+    entities_from_ids,
+    fetch_sequences,
+    id_filter,
+    ids_from_term,
     register_handler,
     UnknownQueryError,
 )
@@ -33,30 +37,33 @@ from api.models import (
     t_rel_regions_types,
 )
 
-from api.search_parser import QueryComponent, QueryOperand, QueryOperation
+from api.search_parser import QueryComponent, QueryOperand
 
 DOMAIN_QUERIES = {}
 DOMAIN_FORMATTERS = {}
 
 
+def _domain_operand_query(term: QueryOperand):
+    '''Generate an SQL query for a single search expression'''
+    if term.category not in DOMAIN_QUERIES:
+        raise UnknownQueryError()
+    return DOMAIN_QUERIES[term.category](term.term)
+
+
+def domain_ids_from_term(term: QueryComponent):
+    '''Generate an SQL SELECT of the ids of the domains matching the search terms'''
+    return ids_from_term(term, _domain_operand_query, AsDomain.as_domain_id)
+
+
 def domain_query_from_term(term: QueryComponent):
-    '''Recursively generate an SQL query from the search terms'''
+    '''Recursively generate an SQL query from the search terms
+
+       Operations are run on the domain ids only, the domains are joined back
+       at the end.
+    '''
     if isinstance(term, QueryOperand):
-        if term.category in DOMAIN_QUERIES:
-            return DOMAIN_QUERIES[term.category](term.term)
-        else:
-            raise UnknownQueryError()
-    elif isinstance(term, QueryOperation):
-        left_query = domain_query_from_term(term.left)
-        right_query = domain_query_from_term(term.right)
-        if term.operator == 'except':
-            return left_query.except_(right_query)
-        elif term.operator == 'or':
-            return left_query.union(right_query)
-        elif term.operator == 'and':
-            return left_query.intersect(right_query)
-
-    raise UnknownQueryError()
+        return _domain_operand_query(term)
+    return entities_from_ids(AsDomain, AsDomain.as_domain_id, domain_ids_from_term(term))
 
 
 def query_taxon_generic():
@@ -188,7 +195,7 @@ def format_fastaa(domains):
     query = db.session.query(AsDomain.as_domain_id, AsDomain.location, AsDomain.translation, AsDomainProfile.name,
                              Cds.locus_tag, DnaSequence.accession, DnaSequence.version)
     query = query.join(AsDomainProfile).join(Cds).join(Region).join(DnaSequence)
-    query = query.filter(AsDomain.as_domain_id.in_(map(lambda x: x.as_domain_id, domains))).order_by(AsDomain.as_domain_id)
+    query = query.filter(id_filter(AsDomain.as_domain_id, map(lambda x: x.as_domain_id, domains))).order_by(AsDomain.as_domain_id)
     search = ''
     if g.verbose:
         search = "|{}".format(g.search_str)
@@ -209,11 +216,15 @@ def format_fasta(domains):
     search = ''
     if g.verbose:
         search = "|{}".format(g.search_str)
+    query = db.session.query(AsDomain, DnaSequence)
+    query = query.join(AsDomainProfile, AsDomain.as_domain_profile).join(Cds, AsDomain.cds).join(Region, Cds.region).join(DnaSequence, Region.dna_sequence)
+    query = query.options(contains_eager(AsDomain.as_domain_profile), contains_eager(AsDomain.cds))
+    query = query.filter(id_filter(AsDomain.as_domain_id, map(lambda x: x.as_domain_id, domains))).order_by(AsDomain.as_domain_id)
+    rows = query.all()
+    sequences = fetch_sequences((record.accession, location_from_string(domain.location)) for domain, record in rows)
     fasta_records = []
-    for domain in domains:
-        record = domain.cds.region.dna_sequence
-        location = location_from_string(domain.location)
-        sequence = break_lines(calculate_sequence(location, record.dna))
+    for (domain, record), sequence in zip(rows, sequences):
+        sequence = break_lines(sequence)
         record = '>{d.cds.locus_tag}|{d.as_domain_profile.name}|{record.accession}.{record.version}|' \
                  '{d.location}{search}\n' \
                  '{sequence}'.format(d=domain, search=search, sequence=sequence, record=record)
@@ -228,7 +239,7 @@ def format_csv(domains):
     query = db.session.query(AsDomain.as_domain_id, AsDomain.translation, AsDomainProfile.name,
                              Cds.locus_tag, AsDomain.location, DnaSequence.accession, DnaSequence.version)
     query = query.join(AsDomainProfile).join(Cds).join(Region).join(DnaSequence)
-    query = query.filter(AsDomain.as_domain_id.in_(map(lambda x: x.as_domain_id, domains))).order_by(AsDomain.as_domain_id)
+    query = query.filter(id_filter(AsDomain.as_domain_id, map(lambda x: x.as_domain_id, domains))).order_by(AsDomain.as_domain_id)
     csv_lines = ['#Locus tag\tDomain type\tAccession\tStart\tEnd\tStrand\tSequence']
     for domain in query:
         csv_lines.append('{d.locus_tag}\t{d.name}\t'
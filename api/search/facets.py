@@ -0,0 +1,155 @@
+'''Faceted statistics on the regions of search results
+
+All requested facets are counted in a single database round trip: the region
+ids of the search are selected once as a CTE, each facet counts the distinct
+regions per value over it, and the facets are combined with UNION ALL.
+'''
+
+from sqlalchemy import (
+    cast,
+    distinct,
+    func,
+    literal,
+    select,
+    String,
+    union_all,
+)
+
+from api.models import (
+    db,
+    AsDomain,
+    BgcType,
+    Cds,
+    ClusterblastAlgorithm,
+    ClusterblastHit,
+    DnaSequence,
+    DsmzCollection,
+    Genome,
+    NbcCollection,
+    NpdcCollection,
+    Region,
+    Taxa,
+    t_rel_regions_types,
+)
+
+from .helpers import (
+    register_handler,
+    UnknownQueryError,
+)
+
+FACETS = {}
+DEFAULT_FACETS = ('type', 'phylum')
+
+
+def _by_taxon(regions, column):
+    return select(column.label('value'), regions.c.region_id) \
+        .join_from(regions, Region, Region.region_id == regions.c.region_id) \
+        .join(DnaSequence, Region.accession == DnaSequence.accession) \
+        .join(Genome, DnaSequence.genome_id == Genome.genome_id) \
+        .join(Taxa, Genome.tax_id == Taxa.tax_id)
+
+
+def _by_type(regions, column):
+    return select(column.label('value'), regions.c.region_id) \
+        .join_from(regions, t_rel_regions_types, t_rel_regions_types.c.region_id == regions.c.region_id) \
+        .join(BgcType, t_rel_regions_types.c.bgc_type_id == BgcType.bgc_type_id)
+
+
+@register_handler(FACETS)
+def facet_type(regions):
+    '''Regions by BGC type'''
+    return _by_type(regions, BgcType.term)
+
+
+@register_handler(FACETS)
+def facet_typecategory(regions):
+    '''Regions by BGC type category'''
+    return _by_type(regions, BgcType.category)
+
+
+@register_handler(FACETS)
+def facet_phylum(regions):
+    '''Regions by phylum'''
+    return _by_taxon(regions, Taxa.phylum)
+
+
+@register_handler(FACETS)
+def facet_genus(regions):
+    '''Regions by genus'''
+    return _by_taxon(regions, Taxa.genus)
+
+
+@register_handler(FACETS)
+def facet_contigedge(regions):
+    '''Regions by whether they're on a contig edge'''
+    return select(cast(Region.contig_edge, String).label('value'), regions.c.region_id) \
+        .join_from(regions, Region, Region.region_id == regions.c.region_id)
+
+
+@register_handler(FACETS)
+def facet_straincollection(regions):
+    '''Regions by the strain collections their genome is available from'''
+    collections = union_all(*[
+        select(literal(name, String).label('collection'), table.genome_id.label('genome_id'))
+        for name, table in [('nbc', NbcCollection), ('npdc', NpdcCollection), ('dsmz', DsmzCollection)]
+    ]).subquery()
+    return select(collections.c.collection.label('value'), regions.c.region_id) \
+        .join_from(regions, Region, Region.region_id == regions.c.region_id) \
+        .join(DnaSequence, Region.accession == DnaSequence.accession) \
+        .join(collections, collections.c.genome_id == DnaSequence.genome_id)
+
+
+@register_handler(FACETS)
+def facet_mibighit(regions):
+    '''Regions by their best KnownClusterBlast hit'''
+    return select(ClusterblastHit.description.label('value'), regions.c.region_id) \
+        .join_from(regions, ClusterblastHit, ClusterblastHit.region_id == regions.c.region_id) \
+        .join(ClusterblastAlgorithm, ClusterblastHit.algorithm_id == ClusterblastAlgorithm.algorithm_id) \
+        .where(ClusterblastAlgorithm.name == 'knownclusterblast') \
+        .where(ClusterblastHit.rank == 1)
+
+
+def region_id_select(search_type, ids):
+    '''Select the distinct ids of the regions containing the search results
+
+       The ids are given as a subquery with a single column of result ids.
+    '''
+    column = list(ids.c)[0]
+    if search_type == 'cluster':
+        return select(column.label('region_id'))
+    if search_type == 'gene':
+        return select(distinct(Cds.region_id).label('region_id')).where(Cds.cds_id.in_(select(column)))
+    if search_type == 'domain':
+        return select(distinct(Cds.region_id).label('region_id')).join_from(Cds, AsDomain) \
+            .where(AsDomain.as_domain_id.in_(select(column)))
+    raise UnknownQueryError()
+
+
+def facet_statement(region_ids, names):
+    '''Build the single statement counting the regions for all named facets'''
+    regions = region_ids.cte('result_regions')
+    counts = []
+    for name in names:
+        rows = FACETS[name](regions).subquery()
+        counts.append(select(literal(name, String).label('facet'), rows.c.value, func.count(distinct(rows.c.region_id)).label('count'))
+                      .group_by(rows.c.value))
+    combined = union_all(*counts).subquery()
+    return select(combined).order_by(combined.c.facet, combined.c.value)
+
+
+def facet_counts(region_ids, names=DEFAULT_FACETS):
+    '''Count the regions per value of the named facets
+
+       Returns a dictionary of facet name to a dictionary of labels and data, the
+       latter holding the region count for each label. Unknown facets and
+       facets without any values are left out.
+    '''
+    names = [name for name in dict.fromkeys(names) if name in FACETS]
+    if not names:
+        return {}
+    facets = {name: ([], []) for name in names}
+    for facet, value, count in db.session.execute(facet_statement(region_ids, names)):
+        labels, data = facets[facet]
+        labels.append(value)
+        data.append(count)
+    return {name: {'labels': labels, 'data': data} for name, (labels, data) in facets.items() if labels}
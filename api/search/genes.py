@@ -11,7 +11,10 @@ from sqlalchemy import (
 )
 from .helpers import (
     break_lines,
-    calculate_sequence,
+    entities_from_ids,
+    fetch_sequences,
+    id_filter,
+    ids_from_term,
     register_handler,
     UnknownQueryError,
 )
@@ -47,7 +50,6 @@ from api.models import (
 from api.search_parser import (
     QueryComponent,
     QueryOperand,
-    QueryOperation,
 )
 
 GENE_QUERIES = {}
@@ -65,29 +67,31 @@ def _generic_count_by_cds_id(query, minimum: int):
 register_countable_handler = partial(register_handler, countable=True, counter=_generic_count_by_cds_id)
 
 
+def _gene_operand_query(term: QueryOperand):
+    '''Generate an SQL query for a single search expression'''
+    if term.category not in GENE_QUERIES:
+        raise UnknownQueryError()
+    handler = GENE_QUERIES[term.category]
+    query = handler(term.term)
+    for query_filter in term.filters:
+        query = query_filter.runner.run(query, query_filter.get_options())
+    return handler.add_count_restriction(query, term.count)
+
+
+def gene_ids_from_term(term: QueryComponent):
+    '''Generate an SQL SELECT of the ids of the genes matching the search terms'''
+    return ids_from_term(term, _gene_operand_query, Cds.cds_id)
+
+
 def gene_query_from_term(term: QueryComponent):
-    '''Recursively generate an SQL query from the search terms'''
+    '''Recursively generate an SQL query from the search terms
+
+       Operations are run on the gene ids only, so the wide columns like the
+       translation are never compared, and the genes are joined back at the end.
+    '''
     if isinstance(term, QueryOperand):
-        if term.category in GENE_QUERIES:
-            handler = GENE_QUERIES[term.category]
-            query = handler(term.term)
-            for query_filter in term.filters:
-                query = query_filter.runner.run(query, query_filter.get_options())
-            query = handler.add_count_restriction(query, term.count)
-            return query
-        else:
-            raise UnknownQueryError()
-    elif isinstance(term, QueryOperation):
-        left_query = gene_query_from_term(term.left)
-        right_query = gene_query_from_term(term.right)
-        if term.operator == 'except':
-            return left_query.except_(right_query)
-        elif term.operator == 'or':
-            return left_query.union(right_query)
-        elif term.operator == 'and':
-            return left_query.intersect(right_query)
-
-    raise UnknownQueryError()
+        return _gene_operand_query(term)
+    return entities_from_ids(Cds, Cds.cds_id, gene_ids_from_term(term))
 
 
 def query_taxon_generic():
@@ -244,17 +248,23 @@ def query_subcluster(term):
 # Formatters #
 #############
 
+def _with_records(genes):
+    '''Load the genes together with their DNA records in a single query'''
+    query = db.session.query(Cds, DnaSequence).join(Region, Cds.region).join(DnaSequence, Region.dna_sequence)
+    return query.filter(id_filter(Cds.cds_id, map(lambda x: x.cds_id, genes))).order_by(Cds.cds_id)
+
+
 @register_handler(GENE_FORMATTERS)
 def format_fasta(genes):
     '''Generate DNA FASTA records for a list of genes'''
     search = ''
     if g.verbose:
         search = "|{}".format(g.search_str)
+    rows = list(_with_records(genes))
+    sequences = fetch_sequences((record.accession, location_from_string(gene.location)) for gene, record in rows)
     fasta_records = []
-    for gene in genes:
-        location = location_from_string(gene.location)
-        record = gene.region.dna_sequence
-        sequence = break_lines(calculate_sequence(location, record.dna))
+    for (gene, record), sequence in zip(rows, sequences):
+        sequence = break_lines(sequence)
         assert sequence
         result = ('>{gene.locus_tag}|{record.accession}.{record.version}|{gene.location}{search}\n'
                   '{sequence}').format(gene=gene, search=search, sequence=sequence, record=record)
@@ -269,8 +279,7 @@ def format_fastaa(genes):
     if g.verbose:
         search = "|{}".format(g.search_str)
     fasta_records = []
-    for gene in genes:
-        record = gene.region.dna_sequence
+    for gene, record in _with_records(genes):
         sequence = break_lines(gene.translation)
         record = ('>{g.locus_tag}|{record.accession}.{record.version}|{g.location}){search}\n'
                   '{sequence}').format(g=gene, search=search, sequence=sequence, record=record)
@@ -283,8 +292,7 @@ def format_fastaa(genes):
 def format_csv(genes):
     '''Generate CSV records for a list of genes'''
     csv_lines = ['#Locus tag\tAccession\tStart\tEnd\tStrand']
-    for gene in genes:
-        record = gene.region.dna_sequence
+    for gene, record in _with_records(genes):
         csv_lines.append('{g.locus_tag}\t{record.accession}.{record.version}\t'
                          '{g.location}'.format(g=gene, record=record))
     return csv_lines
@@ -1,6 +1,36 @@
 '''general helper functions for search'''
 from enum import auto, Enum, unique
-from typing import Any, Callable, Optional
+from itertools import count
+from typing import Any, Callable, Iterable, Optional
+
+from flask import current_app
+from sqlalchemy import (
+    any_,
+    bindparam,
+    column,
+    Column,
+    except_,
+    func,
+    Integer,
+    intersect,
+    MetaData,
+    select,
+    Table,
+    Text,
+    text,
+    union,
+)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql import ClauseElement
+
+from api.models import db, DnaSequence
+from api.sequence_store import get_sequence_store
+
+SET_OPERATIONS = {
+    'and': intersect,
+    'or': union,
+    'except': except_,
+}
 
 
 class UnknownQueryError(Exception):
@@ -137,6 +167,61 @@ def register_handler(handler, countable: bool = False, counter: Callable = None,
     return real_decorator
 
 
+def ids_from_term(term, operand_query: Callable, key):
+    '''Recursively build an id-only SELECT for the search terms
+
+       Each operand only selects the primary key column, labelled with its name,
+       so the set operations of AND/OR/EXCEPT compare single integers instead
+       of whole rows.
+    '''
+    if term.kind == 'expression':
+        return operand_query(term).with_entities(key.label(key.key)).statement
+    if term.kind == 'operation':
+        if term.operator not in SET_OPERATIONS:
+            raise UnknownQueryError()
+        left = ids_from_term(term.left, operand_query, key)
+        right = ids_from_term(term.right, operand_query, key)
+        return SET_OPERATIONS[term.operator](left, right)
+
+    raise UnknownQueryError()
+
+
+def entities_from_ids(model, key, ids):
+    '''Build a query for the entities with the ids selected by an id-only SELECT'''
+    ids = ids.subquery()
+    return model.query.join(ids, key == ids.c[key.key])
+
+
+_TEMPORARY_TABLES = count()
+
+
+def _temporary_id_table(ids, id_type):
+    '''Load the ids into a temporary table that is dropped at the end of the transaction'''
+    table = Table('tmp_ids_{}'.format(next(_TEMPORARY_TABLES)), MetaData(),
+                  Column('id', id_type, primary_key=True),
+                  prefixes=['TEMPORARY'], postgresql_on_commit='DROP')
+    table.create(db.session.connection())
+    db.session.execute(table.insert(), [{'id': i} for i in ids])
+    db.session.execute(text('ANALYZE {}'.format(table.name)))
+    return table
+
+
+def id_filter(column, ids: Iterable[int]):
+    '''Build a filter restricting the column to a collection of ids
+
+       The ids are bound as a single array parameter, `column = ANY(:ids)`, so
+       the statement stays the same size however many ids there are. Very large
+       sets are loaded into a temporary table instead. Subqueries and selects
+       are passed on to a plain IN.
+    '''
+    if isinstance(ids, ClauseElement) or hasattr(ids, 'subquery'):
+        return column.in_(ids)
+    ids = set(ids)
+    if len(ids) >= current_app.config['ID_TEMP_TABLE_THRESHOLD']:
+        return column.in_(select(_temporary_id_table(ids, column.type).c.id))
+    return column == any_(bindparam('ids', sorted(ids), type_=ARRAY(column.type), unique=True))
+
+
 def break_lines(string, width=80):
     '''Break up a long string to lines of width (default: 80)'''
     parts = []
@@ -171,6 +256,64 @@ def calculate_sequence(location, sequence):
     return result
 
 
+def slice_statement():
+    '''Build the statement selecting the (accessions, starts, stops) slices of DNA records
+
+       The slices are bound as three parallel arrays and numbered from 1 in
+       the order given, the coordinates are zero-based and end-exclusive.
+    '''
+    slices = func.unnest(bindparam('accessions', type_=ARRAY(Text)),
+                         bindparam('starts', type_=ARRAY(Integer)),
+                         bindparam('stops', type_=ARRAY(Integer))) \
+        .table_valued(column('accession', Text), column('start', Integer), column('stop', Integer), with_ordinality='n') \
+        .render_derived('slices')
+    return select(slices.c.n, func.substr(DnaSequence.dna, slices.c.start + 1, slices.c.stop - slices.c.start)) \
+        .join_from(slices, DnaSequence, DnaSequence.accession == slices.c.accession)
+
+
+def fetch_slices(slices):
+    '''Fetch a list of (accession, start, end) slices of DNA records in a single query
+
+       Slices are read from the local sequence store if there is one, otherwise
+       only the requested coordinates are transferred from the database, the
+       records themselves are never loaded. Slices of unknown records are empty.
+    '''
+    slices = list(slices)
+    result = [''] * len(slices)
+    store = get_sequence_store() if slices else None
+    if store is not None:
+        for index, (accession, start, end) in enumerate(slices):
+            if accession in store:
+                result[index] = store.slice(accession, start, end)
+        slices = [(index, *part) for index, part in enumerate(slices) if part[0] not in store]
+    else:
+        slices = [(index, *part) for index, part in enumerate(slices)]
+    if not slices:
+        return result
+    indices, accessions, starts, stops = map(list, zip(*slices))
+    for index, sequence in db.session.execute(slice_statement(), {'accessions': accessions, 'starts': starts, 'stops': stops}):
+        result[indices[index - 1]] = sequence or ''
+    return result
+
+
+def fetch_sequences(features):
+    '''Fetch the strand-aware sequences of a list of (accession, location) features
+
+       The parts of all features are grouped by record and fetched with a
+       single query, see fetch_slices().
+    '''
+    features = list(features)
+    unique = sorted({(accession, part.start, part.end) for accession, location in features for part in location.parts})
+    fetched = dict(zip(unique, fetch_slices(unique)))
+    sequences = []
+    for accession, location in features:
+        sequence = "".join(fetched[(accession, part.start, part.end)] for part in location.parts)
+        if location.strand == -1:
+            sequence = reverse_complement(sequence)
+        sequences.append(sequence)
+    return sequences
+
+
 TRANS_TABLE = str.maketrans('ATGCatgc', 'TACGtacg')
 
 
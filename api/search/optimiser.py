@@ -0,0 +1,85 @@
+'''Optimisation of boolean query trees before they are turned into SQL
+
+The query builder in the web UI produces trees exactly as the user clicked
+them together, with nested chains of the same operator, repeated operands and
+branches that can't match anything. The trees are rewritten so that:
+    - chains of AND or OR are flattened and duplicate operands are removed
+    - AND operands are ordered by their estimated number of results, smallest first
+    - branches known to match nothing are short-circuited
+'''
+
+import json
+from functools import reduce
+from typing import Callable
+
+from api.search_parser import QueryComponent, QueryOperation
+
+
+def _canonical(term: QueryComponent) -> str:
+    return json.dumps(term.to_json(), sort_keys=True)
+
+
+def _flatten(term: QueryComponent, operator: str) -> list[QueryComponent]:
+    '''Collect the operands of a chain of the same operator'''
+    if term.kind == 'operation' and term.operator == operator:
+        return _flatten(term.left, operator) + _flatten(term.right, operator)
+    return [term]
+
+
+def _unique(children: list[tuple[QueryComponent, int]]) -> list[tuple[QueryComponent, int]]:
+    seen = set()
+    unique = []
+    for child in children:
+        key = _canonical(child[0])
+        if key not in seen:
+            seen.add(key)
+            unique.append(child)
+    return unique
+
+
+def _combine(operator: str, terms: list[QueryComponent]) -> QueryComponent:
+    return reduce(lambda left, right: QueryOperation(operator, left, right), terms)
+
+
+def _optimise(term: QueryComponent, estimate: Callable) -> tuple[QueryComponent, int]:
+    '''Optimise the tree, returning the new tree and its estimated number of results'''
+    if term.kind == 'expression':
+        return term, estimate(term)
+
+    if term.kind != 'operation':
+        return term, 0
+
+    if term.operator == 'except':
+        left, left_size = _optimise(term.left, estimate)
+        if not left_size:
+            return left, 0
+        right, right_size = _optimise(term.right, estimate)
+        if not right_size:
+            return left, left_size
+        return QueryOperation('except', left, right), left_size
+
+    children = _unique([_optimise(child, estimate) for child in _flatten(term, term.operator)])
+
+    if term.operator == 'and':
+        children.sort(key=lambda child: child[1])
+        if not children[0][1]:
+            return children[0]
+        return _combine('and', [child[0] for child in children]), children[0][1]
+
+    matching = [child for child in children if child[1]]
+    if not matching:
+        return children[0]
+    return _combine(term.operator, [child[0] for child in matching]), sum(child[1] for child in matching)
+
+
+def optimise(term: QueryComponent, estimate: Callable[[QueryComponent], int]) -> QueryComponent:
+    '''Rewrite a query tree into an equivalent, cheaper one
+
+       The estimate function is called with single operands and returns the
+       (estimated) number of results of that operand. Zero means the operand
+       is known to have no results, so it must only be returned for exact counts.
+       Single operands are returned unchanged without estimating them.
+    '''
+    if term.kind != 'operation':
+        return term
+    return _optimise(term, estimate)[0]
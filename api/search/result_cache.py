@@ -0,0 +1,90 @@
+'''Cache of the ordered result ids of recent searches
+
+The web UI sends the same query for the results, the stats and every page
+change, so the primary keys of the results are kept in the shared cache as a
+compressed array and reused instead of running the search again.
+
+Results with too many ids to cache are only marked as oversized, together with
+their number, so later pages go straight to the database.
+'''
+
+from array import array
+import json
+import zlib
+from typing import Optional
+
+from flask import current_app
+
+from api.cache import get_cache, make_key
+
+
+def encode_ids(ids: array) -> bytes:
+    '''Pack an array of ids into a compressed blob of 64-bit integers'''
+    if ids.typecode != 'q':
+        ids = array('q', ids)
+    return zlib.compress(ids.tobytes(), 1)
+
+
+def decode_ids(blob: bytes) -> array:
+    '''Unpack an array of ids packed by encode_ids'''
+    ids = array('q')
+    ids.frombytes(zlib.decompress(blob))
+    return ids
+
+
+def result_cache_enabled() -> bool:
+    '''Whether search results should be cached at all'''
+    return current_app.config.get('RESULT_CACHE_MAX_IDS', 0) > 0
+
+
+def cache_key(query) -> str:
+    '''Get the cache key for a query
+
+       The return type and verbosity don't change the results, so they're not
+       part of the key.
+    '''
+    canonical = query.to_json()
+    canonical.pop('return_type', None)
+    canonical.pop('verbose', None)
+    return make_key('search', json.dumps(canonical, sort_keys=True))
+
+
+def get_cached_ids(key: str) -> Optional[array]:
+    '''Get the result ids cached for the key, if any'''
+    blob = get_cache().get(key)
+    if blob is None:
+        return None
+    return decode_ids(blob)
+
+
+def set_cached_ids(key: str, ids: array) -> bool:
+    '''Cache the result ids for the key, unless there are too many of them
+
+       Returns whether the ids were cached. Ids that would be too large for a
+       single value of the cache backend aren't cached either.
+    '''
+    if len(ids) > current_app.config.get('RESULT_CACHE_MAX_IDS', 0):
+        return False
+    blob = encode_ids(ids)
+    cache = get_cache()
+    if cache.max_item_size is not None and len(blob) > cache.max_item_size:
+        return False
+    cache.set(key, blob, current_app.config.get('RESULT_CACHE_TTL'))
+    return True
+
+
+def _oversized_key(key: str) -> str:
+    return make_key('search.oversized', key)
+
+
+def get_oversized_total(key: str) -> Optional[int]:
+    '''Get the number of results cached for a key whose ids were too many to cache, if any'''
+    blob = get_cache().get(_oversized_key(key))
+    if blob is None:
+        return None
+    return int(blob)
+
+
+def set_oversized_total(key: str, total: int) -> None:
+    '''Mark the ids of the key as too many to cache, remembering just their number'''
+    get_cache().set(_oversized_key(key), str(total).encode('ascii'), current_app.config.get('RESULT_CACHE_TTL'))
@@ -0,0 +1,184 @@
+'''A memory-mapped store of the DNA of all records, packed at 4 bits per nucleotide
+
+The store is a single file per database release, built with the
+build-sequence-store command and enabled with the SEQUENCE_STORE config option.
+Its layout is:
+    header:  magic, length of the index, length of the database version
+    version: the database_version() the store was built from
+    index:   JSON mapping each accession to the byte offset and length of its
+             record, the runs of lowercase nucleotides and the positions of
+             characters that aren't IUPAC nucleotide codes, with those characters
+    records: two nucleotides per byte, high nibble first
+
+Slices are returned exactly as the sequences are stored in the database, in the
+same case and with the same characters.
+
+The file is memory-mapped, so all workers on a host share its pages through the
+OS page cache. Slicing a record only reads and copies the packed bytes covering
+the slice, which are then decoded into a new string.
+'''
+
+from bisect import bisect_left, bisect_right
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+from typing import Iterable, Optional
+
+from flask import current_app
+
+from .cache import database_version
+from .models import db, DnaSequence
+
+MAGIC = b'ASDBSEQ2'
+HEADER = struct.Struct('<8sQQ')
+
+# the IUPAC nucleotide codes, anything else is stored as N and restored from the index
+ALPHABET = b'-ACGTRYSWKMBDHVN'
+UNKNOWN = ALPHABET.index(b'N')
+LOWERCASE = re.compile(rb'[a-z]+')
+NON_IUPAC = re.compile(rb'[^-ACGTRYSWKMBDHVNacgtryswkmbdhvn]')
+
+_ENCODE_HIGH = bytes((ALPHABET.find(bytes([c]).upper()) if bytes([c]).upper() in ALPHABET else UNKNOWN) << 4 for c in range(256))
+_ENCODE_LOW = bytes(code >> 4 for code in _ENCODE_HIGH)
+_DECODE_HIGH = bytes(ALPHABET[c >> 4] for c in range(256))
+_DECODE_LOW = bytes(ALPHABET[c & 0xF] for c in range(256))
+
+
+def pack(sequence: bytes) -> bytes:
+    '''Pack a nucleotide sequence into 4 bits per nucleotide'''
+    high = sequence[0::2].translate(_ENCODE_HIGH)
+    low = sequence[1::2].translate(_ENCODE_LOW).ljust(len(high), b'\0')
+    combined = int.from_bytes(high, 'big') | int.from_bytes(low, 'big')
+    return combined.to_bytes(len(high), 'big')
+
+
+def unpack(packed: bytes, start: int, end: int) -> bytes:
+    '''Unpack the nucleotides from start to end of a packed sequence'''
+    first, last = start // 2, (end + 1) // 2
+    chunk = packed[first:last]
+    result = bytearray(2 * len(chunk))
+    result[0::2] = chunk.translate(_DECODE_HIGH)
+    result[1::2] = chunk.translate(_DECODE_LOW)
+    offset = start - 2 * first
+    return bytes(result[offset:offset + end - start])
+
+
+def _restore(sequence: bytearray, start: int, lowercase: list[int], others: list[list]) -> None:
+    '''Restore the case and the non-IUPAC characters of a slice starting at start'''
+    end = start + len(sequence)
+    # lowercase is a flat list of run starts and ends, the runs don't overlap
+    first = bisect_right(lowercase, start)
+    if first % 2:
+        first -= 1
+    for i in range(first, bisect_left(lowercase, end), 2):
+        run_start, run_end = max(lowercase[i], start) - start, min(lowercase[i + 1], end) - start
+        sequence[run_start:run_end] = sequence[run_start:run_end].lower()
+    positions = [position for position, _ in others]
+    for i in range(bisect_left(positions, start), bisect_left(positions, end)):
+        position, char = others[i]
+        sequence[position - start] = ord(char)
+
+
+class SequenceStore:
+    '''Read access to a sequence store file'''
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_size, version_size = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError("not a sequence store: %s" % path)
+        start = HEADER.size
+        self.version = self._map[start:start + version_size].decode()
+        start += version_size
+        self._index = json.loads(self._map[start:start + index_size])
+        self._data_start = start + index_size
+
+    def __contains__(self, accession: str) -> bool:
+        return accession in self._index
+
+    def slice(self, accession: str, start: int, end: int) -> str:
+        '''Get the nucleotides from start to end of a record, clipped to the record'''
+        offset, length, lowercase, others = self._index[accession]
+        start, end = max(start, 0), min(end, length)
+        if start >= end:
+            return ''
+        packed = self._map[self._data_start + offset + start // 2:self._data_start + offset + (end + 1) // 2]
+        sequence = bytearray(unpack(packed, start % 2, start % 2 + end - start))
+        if lowercase or others:
+            _restore(sequence, start, lowercase, others)
+        return sequence.decode('ascii')
+
+    def close(self) -> None:
+        self._map.close()
+
+
+def write_store(path: str, records: Iterable[tuple[str, str]], version: str) -> int:
+    '''Write a sequence store of the (accession, dna) records, returning the number of records
+
+       The store is written to a temporary file first and then moved into place,
+       so running workers never see a partial store.
+    '''
+    index = {}
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.sequences')
+    try:
+        with tempfile.TemporaryFile() as data, os.fdopen(handle, 'wb') as output:
+            offset = 0
+            for accession, dna in records:
+                encoded = (dna or '').encode('ascii', errors='replace')
+                lowercase = [position for match in LOWERCASE.finditer(encoded) for position in match.span()]
+                others = [(match.start(), match.group().decode('ascii')) for match in NON_IUPAC.finditer(encoded)]
+                packed = pack(encoded)
+                index[accession] = (offset, len(encoded), lowercase, others)
+                data.write(packed)
+                offset += len(packed)
+            encoded_index = json.dumps(index, separators=(',', ':')).encode()
+            encoded_version = version.encode()
+            output.write(HEADER.pack(MAGIC, len(encoded_index), len(encoded_version)))
+            output.write(encoded_version)
+            output.write(encoded_index)
+            data.seek(0)
+            while chunk := data.read(1 << 24):
+                output.write(chunk)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return len(index)
+
+
+def build_store(path: str, batch_size: int = 100) -> int:
+    '''Build the sequence store for the current database contents'''
+    query = db.session.query(DnaSequence.accession, DnaSequence.dna).order_by(DnaSequence.accession).yield_per(batch_size)
+    return write_store(path, ((row.accession, row.dna) for row in query), database_version())
+
+
+_STORE = {'key': None, 'store': None}
+_STORE_LOCK = threading.Lock()
+
+
+def get_sequence_store() -> Optional[SequenceStore]:
+    '''Get the sequence store, if one is configured and matches the current database contents'''
+    path = current_app.config.get('SEQUENCE_STORE')
+    if not path:
+        return None
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
+    with _STORE_LOCK:
+        if _STORE['key'] != key:
+            try:
+                _STORE['store'] = SequenceStore(path)
+            except (OSError, ValueError, struct.error) as err:
+                current_app.logger.warning("invalid sequence store %s: %s", path, err)
+                _STORE['store'] = None
+            _STORE['key'] = key
+        store = _STORE['store']
+    if store is None or store.version != database_version():
+        return None
+    return store
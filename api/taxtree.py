@@ -1,171 +1,203 @@
-'''Functions related to building the taxonomic tree data'''
-from sqlalchemy import func, or_
+'''Functions related to building the taxonomic tree data
 
+The tree is answered from an in-memory index of the taxonomy that is built
+with two queries and rebuilt whenever the database contents change.
+'''
+from collections import Counter, defaultdict
+import threading
+
+from flask import current_app
+
+from .cache import database_version
 from .models import (
     db,
-    DnaSequence,
     Genome,
     Taxa,
 )
 
+LEVELS = ('superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+NGRAM_SIZE = 3
+
+
+def _lower(value):
+    return value.lower() if value is not None else ''
+
+
+def _ngrams(text):
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+def _sort_key(value):
+    '''Approximate the database collation, which mostly ignores case'''
+    if value is None:
+        return (True, '', '')
+    return (False, value.casefold(), value)
+
+
+class TaxonIndex:
+    '''An in-memory index of the taxonomy with precomputed genome counts
+
+       Nodes are addressed by the lowercased names of their ancestors, matching
+       the case-insensitive lookups of the jsTree ids.
+    '''
+
+    def __init__(self, taxa, genomes):
+        '''taxa are (tax_id, superkingdom, ..., species, strain) tuples,
+           genomes are (tax_id, assembly_id) tuples
+        '''
+        self.children = defaultdict(Counter)
+        self.strains = defaultdict(list)
+        self.lineages = {}
+        self.taxa = []
+        # the distinct lowercased genus, species and strain names, with the taxa using them
+        self.names = defaultdict(set)
+        self.ngrams = defaultdict(set)
+
+        for tax_id, *lineage, strain in taxa:
+            lineage = tuple(lineage)
+            self.lineages[tax_id] = (lineage, strain)
+            for name in (lineage[5], lineage[6], strain):
+                if name is not None:
+                    self.names[name.lower()].add(len(self.taxa))
+            self.taxa.append((lineage, strain))
+
+        for name in self.names:
+            for ngram in _ngrams(name):
+                self.ngrams[ngram].add(name)
+
+        for tax_id, assembly_id in genomes:
+            if tax_id not in self.lineages:
+                continue
+            lineage, strain = self.lineages[tax_id]
+            for depth, name in enumerate(lineage):
+                path = tuple(map(_lower, lineage[:depth]))
+                self.children[path][name] += int(assembly_id is not None)
+            if assembly_id is not None:
+                self.strains[tuple(map(_lower, lineage))].append((strain, lineage[5], lineage[6], assembly_id))
+
+        for strains in self.strains.values():
+            strains.sort(key=lambda strain: _sort_key(strain[0]))
+
+    def children_of(self, params):
+        '''Get the sorted (name, genome count) pairs below the node at the given path'''
+        counts = self.children.get(tuple(map(_lower, params)), {})
+        return sorted(counts.items(), key=lambda item: _sort_key(item[0]))
+
+    def strains_of(self, params):
+        '''Get the sorted (strain, genus, species, assembly_id) tuples of a species path'''
+        return self.strains.get(tuple(map(_lower, params)), [])
+
+    def search(self, search_term, limit=None):
+        '''Get the lineages of the taxa where genus, species or strain contain the search term
+
+           Candidate names are found via the n-grams of the term, so only the
+           names sharing all of them are compared. At most limit lineages are
+           returned, if given.
+        '''
+        term = search_term.lower()
+        ngrams = _ngrams(term)
+        if ngrams:
+            postings = sorted((self.ngrams.get(ngram, set()) for ngram in ngrams), key=len)
+            candidates = set.intersection(*postings)
+        else:
+            candidates = self.names.keys()
+
+        matches = set()
+        for name in candidates:
+            if term in name:
+                matches.update(self.names[name])
+
+        return [self.taxa[i][0] for i in sorted(matches)[:limit]]
+
+
+_INDEX = {'version': None, 'index': None}
+_INDEX_LOCK = threading.Lock()
+
+
+def build_index():
+    '''Build a new taxonomy index from the database'''
+    taxa = db.session.query(Taxa.tax_id, Taxa.superkingdom, Taxa.phylum, Taxa._class, Taxa.taxonomic_order,
+                            Taxa.family, Taxa.genus, Taxa.species, Taxa.strain)
+    genomes = db.session.query(Genome.tax_id, Genome.assembly_id)
+    return TaxonIndex(taxa.all(), genomes.all())
+
+
+def get_index():
+    '''Get the taxonomy index for the current database contents'''
+    version = database_version()
+    with _INDEX_LOCK:
+        if _INDEX['index'] is None or _INDEX['version'] != version:
+            _INDEX['index'] = build_index()
+            _INDEX['version'] = version
+        return _INDEX['index']
+
 
 def search(search_term):
     """Get a taxtree path where genus, species or strain matches the search term."""
-    kingdoms = set()
-    phyla = set()
-    classes = set()
-    orders = set()
-    families = set()
-    genera = set()
-    species = set()
-
-    filters = [
-       Taxa.genus.ilike('%{}%'.format(search_term)),
-       Taxa.species.ilike('%{}%'.format(search_term)),
-       Taxa.strain.ilike('%{}%'.format(search_term)),
-    ]
-
-    hits = db.session.query(Taxa.superkingdom, Taxa.phylum, Taxa._class, Taxa.taxonomic_order,
-                            Taxa.family, Taxa.genus, Taxa.species) \
-                     .filter(or_(*filters))
-    for hit in hits.all():
-        kingdoms.add('superkingdom_{}'.format(hit[0]).lower())
-        phyla.add('phylum_{}'.format('_'.join(hit[0:2])).lower())
-        classes.add('class_{}'.format('_'.join(hit[0:3])).lower())
-        orders.add('order_{}'.format('_'.join(hit[0:4])).lower())
-        families.add('family_{}'.format('_'.join(hit[0:5])).lower())
-        genera.add('genus_{}'.format('_'.join(hit[0:6])).lower())
-        species.add('species_{}'.format('_'.join(hit[0:7])).lower())
-
-    tax_path = sorted(list(kingdoms))
-    tax_path.extend(sorted(list(phyla)))
-    tax_path.extend(sorted(list(classes)))
-    tax_path.extend(sorted(list(orders)))
-    tax_path.extend(sorted(list(families)))
-    tax_path.extend(sorted(list(genera)))
-    tax_path.extend(sorted(list(species)))
+    levels = [set() for _ in LEVELS]
+
+    limit = current_app.config.get('TAXTREE_SEARCH_LIMIT') or None
+    for lineage in get_index().search(search_term, limit):
+        for depth, level in enumerate(LEVELS):
+            levels[depth].add('{}_{}'.format(level, '_'.join(map(str, lineage[:depth + 1]))).lower())
+
+    tax_path = []
+    for paths in levels:
+        tax_path.extend(sorted(paths))
 
     return tax_path
 
 
+def _get_children(params, depth):
+    '''Get the jsTree nodes of the taxonomic level below the given path'''
+    tree = []
+    params = params[:depth]
+    for name, count in get_index().children_of(params):
+        id_list = params + [_lower(name)]
+        tree.append(_create_tree_node('{}_{}'.format(LEVELS[depth], '_'.join(id_list)),
+                                      '{}_{}'.format(LEVELS[depth - 1], '_'.join(params)),
+                                      '{} ({})'.format(name, count)))
+    return tree
+
+
 def get_superkingdom():
     '''Get list of superkingdoms'''
     tree = []
-    kingdoms = db.session.query(Taxa.superkingdom, func.count(Genome.assembly_id)) \
-                         .join(Genome) \
-                         .group_by(Taxa.superkingdom).order_by(Taxa.superkingdom)
-    for kingdom in kingdoms:
-        tree.append(_create_tree_node('superkingdom_{}'.format(kingdom[0].lower()),
-                                      '#', '{} ({})'.format(kingdom[0], kingdom[1])))
+    for kingdom, count in get_index().children_of([]):
+        tree.append(_create_tree_node('superkingdom_{}'.format(_lower(kingdom)),
+                                      '#', '{} ({})'.format(kingdom, count)))
 
     return tree
 
 
 def get_phylum(params):
     '''Get list of phyla per kingdom'''
-    tree = []
-    phyla = db.session.query(Taxa.phylum, func.count(Genome.assembly_id)) \
-                      .join(Genome) \
-                      .filter(Taxa.superkingdom.ilike(params[0])) \
-                      .group_by(Taxa.phylum).order_by(Taxa.phylum)
-    for phylum in phyla:
-        id_list = params + [phylum[0].lower()]
-        tree.append(_create_tree_node('phylum_{}'.format('_'.join(id_list)),
-                                      'superkingdom_{}'.format('_'.join(params)),
-                                      '{} ({})'.format(phylum[0], phylum[1])))
-
-    return tree
+    return _get_children(params, 1)
 
 
 def get_class(params):
     '''Get list of classes per kingdom/phylum'''
-    tree = []
-    classes = db.session.query(Taxa._class, func.count(Genome.assembly_id)) \
-                        .join(Genome) \
-                        .filter(Taxa.superkingdom.ilike(params[0])) \
-                        .filter(Taxa.phylum.ilike(params[1])) \
-                        .group_by(Taxa._class).order_by(Taxa._class)
-    for cls in classes:
-        id_list = params + [cls[0].lower()]
-        tree.append(_create_tree_node('class_{}'.format('_'.join(id_list)),
-                                      'phylum_{}'.format('_'.join(params)),
-                                      '{} ({})'.format(cls[0], cls[1])))
-    return tree
+    return _get_children(params, 2)
 
 
 def get_order(params):
     '''Get list of oders per kingdom/phylum/class'''
-    tree = []
-    orders = db.session.query(Taxa.taxonomic_order, func.count(Genome.assembly_id)) \
-                       .join(Genome) \
-                       .filter(Taxa.superkingdom.ilike(params[0])) \
-                       .filter(Taxa.phylum.ilike(params[1])) \
-                       .filter(Taxa._class.ilike(params[2])) \
-                       .group_by(Taxa.taxonomic_order).order_by(Taxa.taxonomic_order)
-    for order in orders:
-        id_list = params + [order[0].lower()]
-        tree.append(_create_tree_node('order_{}'.format('_'.join(id_list)),
-                                      'class_{}'.format('_'.join(params)),
-                                      '{} ({})'.format(order[0], order[1])))
-    return tree
+    return _get_children(params, 3)
 
 
 def get_family(params):
     '''Get list of families per kingdom/phylum/class/order'''
-    tree = []
-    families = db.session.query(Taxa.family, func.count(Genome.assembly_id)) \
-                         .join(Genome) \
-                         .filter(Taxa.superkingdom.ilike(params[0])) \
-                         .filter(Taxa.phylum.ilike(params[1])) \
-                         .filter(Taxa._class.ilike(params[2])) \
-                         .filter(Taxa.taxonomic_order.ilike(params[3])) \
-                         .group_by(Taxa.family).order_by(Taxa.family)
-    for family in families:
-        id_list = params + [family[0].lower()]
-        tree.append(_create_tree_node('family_{}'.format('_'.join(id_list)),
-                                      'order_{}'.format('_'.join(params)),
-                                      '{} ({})'.format(family[0], family[1])))
-    return tree
+    return _get_children(params, 4)
 
 
 def get_genus(params):
     '''Get list of genera per kingdom/phylum/class/order/family'''
-    tree = []
-    genera = db.session.query(Taxa.genus, func.count(Genome.assembly_id)) \
-                       .join(Genome) \
-                       .filter(Taxa.superkingdom.ilike(params[0])) \
-                       .filter(Taxa.phylum.ilike(params[1])) \
-                       .filter(Taxa._class.ilike(params[2])) \
-                       .filter(Taxa.taxonomic_order.ilike(params[3])) \
-                       .filter(Taxa.family.ilike(params[4])) \
-                       .group_by(Taxa.genus).order_by(Taxa.genus)
-    for genus in genera:
-        id_list = params + [genus[0].lower()]
-        tree.append(_create_tree_node('genus_{}'.format('_'.join(id_list)),
-                                      'family_{}'.format('_'.join(params)),
-                                      '{} ({})'.format(genus[0], genus[1])))
-    return tree
+    return _get_children(params, 5)
 
 
 def get_species(params):
     '''Get list of species per kingdom/phylum/class/order/family/genus'''
-    tree = []
-    species = db.session.query(Taxa.species, func.count(Genome.assembly_id)) \
-                        .join(Genome) \
-                        .filter(Taxa.superkingdom.ilike(params[0])) \
-                        .filter(Taxa.phylum.ilike(params[1])) \
-                        .filter(Taxa._class.ilike(params[2])) \
-                        .filter(Taxa.taxonomic_order.ilike(params[3])) \
-                        .filter(Taxa.family.ilike(params[4])) \
-                        .filter(Taxa.genus.ilike(params[5])) \
-                        .group_by(Taxa.species).order_by(Taxa.species)
-    for sp in species:
-        id_list = params + [sp[0].lower()]
-        tree.append(_create_tree_node('species_{}'.format('_'.join(id_list)),
-                                      'genus_{}'.format('_'.join(params)),
-                                      '{} ({})'.format(sp[0], sp[1])))
-
-    return tree
+    return _get_children(params, 6)
 
 
 def get_strains(params):
@@ -174,22 +206,11 @@ def get_strains(params):
         params[6] = "_".join(params[6:])
         params = params[:7]
     tree = []
-    strains = db.session.query(Taxa.tax_id, Taxa.genus, Taxa.species, Taxa.strain,
-                               Genome.assembly_id) \
-                        .join(Genome) \
-                        .filter(Taxa.superkingdom.ilike(params[0])) \
-                        .filter(Taxa.phylum.ilike(params[1])) \
-                        .filter(Taxa._class.ilike(params[2])) \
-                        .filter(Taxa.taxonomic_order.ilike(params[3])) \
-                        .filter(Taxa.family.ilike(params[4])) \
-                        .filter(Taxa.genus.ilike(params[5])) \
-                        .filter(Taxa.species.ilike(params[6])) \
-                        .order_by(Taxa.strain)
-    for strain in strains:
-        tree.append(_create_tree_node('{}'.format(strain.assembly_id.lower()),
+    for strain, genus, species, assembly_id in get_index().strains_of(params):
+        tree.append(_create_tree_node('{}'.format(assembly_id.lower()),
                                       'species_{}'.format('_'.join(params)),
-                                      '{s.genus} {s.species} {s.strain} {s.assembly_id}'.format(s=strain),
-                                      assembly_id=strain.assembly_id,
+                                      '{} {} {} {}'.format(genus, species, strain, assembly_id),
+                                      assembly_id=assembly_id,
                                       disabled=False, leaf=True))
     return tree
 
@@ -1,4 +1,7 @@
+from contextlib import contextmanager
+
 import pytest
+from sqlalchemy import event
 from api import app as flask_app
 from api.models import db as _db
 
@@ -43,3 +46,23 @@ def session(db, request):
 
     request.addfinalizer(teardown)
     return session
+
+
+@pytest.fixture(scope='function')
+def query_budget(db):
+    '''Context manager failing if the block runs more than the given number of queries'''
+    @contextmanager
+    def budget(maximum):
+        statements = []
+
+        def record(conn, cursor, statement, *_):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        assert len(statements) <= maximum, "{} queries:\n{}".format(len(statements), "\n".join(statements))
+
+    return budget
@@ -1,4 +1,5 @@
 import json
+import pytest
 from flask import url_for
 from api import api, taxtree
 
@@ -69,6 +70,18 @@ def test_stats(client):
     assert results.json == expected
 
 
+def test_stats_conditional(client):
+    '''Test /api/v2.0/stats answers conditional requests without a body'''
+    results = client.get(url_for('get_stats_v2'))
+    assert results.status_code == 200
+    assert results.headers['ETag']
+    assert results.headers['Last-Modified']
+
+    cached = client.get(url_for('get_stats_v2'), headers={'If-None-Match': results.headers['ETag']})
+    assert cached.status_code == 304
+    assert not cached.data
+
+
 def test_categories_have_filters():
     def check_filter(filt):
         value = filt["value"]
@@ -224,6 +237,25 @@ def test_search_paginate(client):
     assert results.json['paginate'] == 5
 
 
+def test_search_count(client):
+    '''Test /api/search/count endpoint'''
+    query = {'query': {'search': 'cluster', 'return_type': 'json', 'terms': {'term_type': 'expr', 'category': 'type', 'value': 'furan'}}}
+    results = client.post(url_for('search_count'), data=json.dumps(query), content_type="application/json")
+    assert results.status_code == 200
+    assert results.json['exact'] is False
+    assert isinstance(results.json['total'], int)
+
+    query['exact'] = True
+    results = client.post(url_for('search_count'), data=json.dumps(query), content_type="application/json")
+    assert results.status_code == 200
+    assert results.json == {'total': 1, 'exact': True}
+
+    query['query']['terms'] = {'term_type': 'expr', 'category': 'modulequery', 'value': 'L=+0'}
+    results = client.post(url_for('search_count'), data=json.dumps(query), content_type="application/json")
+    assert results.status_code == 400
+    assert 'incompatible combination' in results.json['message']
+
+
 def test_export(client):
     '''Test /api/v1.0/export endpoint'''
 
@@ -340,3 +372,133 @@ def test_available_filter_values(client):
     results = client.get(url_for("list_available_filter_values", category="candidatekind", filter_name="bgctype", term="tr"))
     assert results.status_code == 200
     assert results.json == expected
+
+
+def test_export_lines(monkeypatch):
+    '''Test exports are assembled correctly from formatted batches'''
+    class FakeQuery:
+        return_type = 'json'
+
+    def batches(results):
+        monkeypatch.setattr(api, 'format_results_batched', lambda *_: iter(results))
+
+    query = FakeQuery()
+    batches([[{'a': 1}, {'a': 2}], [{'a': 3}]])
+    assert ''.join(api._export_lines(query, [1, 2, 3])) == json.dumps([{'a': 1}, {'a': 2}, {'a': 3}]) + '\n'
+
+    batches([[]])
+    assert ''.join(api._export_lines(query, [])) == '[]\n'
+
+    query.return_type = 'csv'
+    batches([['#header', 'one', 'two'], ['#header', 'three']])
+    assert list(api._export_lines(query, [1, 2, 3])) == ['#header\n', 'one\n', 'two\n', 'three\n']
+
+    query.return_type = 'fasta'
+    batches([['>one\nACGT'], ['>two\nTTTT']])
+    assert list(api._export_lines(query, [1, 2])) == ['>one\nACGT\n', '>two\nTTTT\n']
+
+
+def test_fasta_limits(monkeypatch):
+    '''Test FASTA downloads are limited by the configured limits and batch size'''
+    class FakeQuery:
+        search_type = 'gene'
+        return_type = 'fasta'
+
+    monkeypatch.setitem(api.app.config, 'FASTA_LIMITS', {'cluster': 1, 'gene': 3, 'domain': 3})
+    query = FakeQuery()
+    api._check_fasta_limit(query, [1, 2, 3])
+    with pytest.raises(api.TooManyResults):
+        api._check_fasta_limit(query, [1, 2, 3, 4])
+    query.return_type = 'csv'
+    api._check_fasta_limit(query, [1, 2, 3, 4])
+
+    used = []
+    monkeypatch.setitem(api.app.config, 'FASTA_BATCH_SIZE', 7)
+    monkeypatch.setattr(api, 'format_results_batched', lambda _query, _ids, size: used.append(size) or iter([]))
+    query.return_type = 'fasta'
+    list(api._export_lines(query, [1]))
+    assert used == [7]
+
+
+def test_export_get_fasta_limits(client, monkeypatch):
+    '''Test only cluster FASTA downloads are limited by the GET export'''
+    monkeypatch.setitem(api.app.config, 'FASTA_LIMITS', {'cluster': 3, 'gene': 3, 'domain': 3})
+    monkeypatch.setattr(api, 'result_ids', lambda query: list(range(10)))
+    monkeypatch.setattr(api, '_export_response', lambda query, ids: 'exported {}'.format(len(ids)))
+
+    for search_type, return_type in [('gene', 'fasta'), ('domain', 'fasta'), ('gene', 'fastaa'),
+                                     ('domain', 'fastaa'), ('cluster', 'fastaa')]:
+        results = client.get(url_for('export_get', search_type=search_type, return_type=return_type, search='{[type|nrps]}'))
+        assert results.status_code == 200
+        assert results.data == b'exported 10'
+
+    results = client.get(url_for('export_get', search_type='cluster', return_type='fasta', search='{[type|nrps]}'))
+    assert results.status_code == 400
+
+
+def test_area_batch(client):
+    '''Test /api/area batch endpoint'''
+    single = client.get(url_for('area_without_version', record='NC_003903', start_pos=0, end_pos=400000))
+    assert single.status_code == 200
+    expected = [region['bgc_id'] for region in single.json['regions']]
+    assert expected
+
+    windows = [['NC_003903', None, 0, 400000], ['NC_003903', None, 0, 400000], ['NC_000000', None, 0, 10]]
+    results = client.post(url_for('area_batch'), data=json.dumps({'windows': windows}), content_type="application/json")
+    assert results.status_code == 200
+    # regions are only formatted once, even if in multiple windows
+    assert results.json['regions'] == single.json['regions']
+    assert [window['regions'] for window in results.json['windows']] == [expected, expected, []]
+
+    for invalid in [None, [['NC_003903', None, 0]], [['NC_003903', None, 'a', 5]]]:
+        results = client.post(url_for('area_batch'), data=json.dumps({'windows': invalid}), content_type="application/json")
+        assert results.status_code == 400
+
+
+def test_goto_bulk(client):
+    '''Test /api/goto bulk resolution endpoint'''
+    identifiers = ['NC_003903.1', 'GCF_000203835.1', 'nonexistent']
+    results = client.post(url_for('goto_bulk'), data=json.dumps({'identifiers': identifiers}), content_type="application/json")
+    assert results.status_code == 200
+    expected_url = '/output/GCF_000203835.1/index.html'
+    assert results.json['results'] == [
+        {'identifier': 'NC_003903.1', 'assembly_id': 'GCF_000203835.1', 'dbv1': False, 'url': expected_url},
+        {'identifier': 'GCF_000203835.1', 'assembly_id': 'GCF_000203835.1', 'dbv1': False, 'url': expected_url},
+        {'identifier': 'nonexistent', 'assembly_id': None, 'dbv1': False, 'url': None},
+    ]
+    single = client.get(url_for('goto', identifier='NC_003903.1'))
+    assert single.headers['Location'].endswith(expected_url)
+
+    results = client.post(url_for('goto_bulk'), data=json.dumps({'identifiers': 'NC_003903'}), content_type="application/json")
+    assert results.status_code == 400
+
+
+def test_sec_met_tree_lazy(client):
+    '''Test /api/v1.0/tree/secmet endpoint with single levels'''
+    full = client.get(url_for('get_sec_met_tree')).json
+
+    types = client.get(url_for('get_sec_met_tree'), query_string="id=%23")
+    assert types.status_code == 200
+    assert [node['id'] for node in types.json] == [node['id'] for node in full if node['parent'] == '#']
+    assert all(node['children'] is True for node in types.json)
+
+    root = client.get(url_for('get_sec_met_tree'), query_string="id=1")
+    assert root.status_code == 200
+    assert root.json == types.json
+
+    regions = client.get(url_for('get_sec_met_tree'), query_string="id=furan")
+    assert regions.status_code == 200
+    assert regions.json == [node for node in full if node['parent'] == 'furan']
+    assert len(regions.json) == 1
+
+    unknown = client.get(url_for('get_sec_met_tree'), query_string="id=bogus")
+    assert unknown.status_code == 200
+    assert unknown.json == []
+
+
+def test_refresh_stats_local_backend(monkeypatch):
+    '''Test refreshing the stats is refused when workers don't share the cache'''
+    monkeypatch.setitem(api.app.config, 'CACHE_BACKEND', 'local')
+    result = api.app.test_cli_runner().invoke(args=['refresh-stats'])
+    assert result.exit_code != 0
+    assert 'local cache backend' in result.output
@@ -0,0 +1,50 @@
+'Tests for the interval index of area lookups'
+
+import random
+
+from api.area_index import IntervalIndex
+
+
+def overlaps(region, start, end):
+    '''Reference overlap check, with areas and regions crossing the origin'''
+    _, region_start, region_end = region
+    if region_start > region_end and end < start:
+        return True
+    if region_start > region_end:
+        return region_start <= end or region_end >= start
+    if end < start:
+        return region_end >= start or region_start <= end
+    return region_start <= end and region_end >= start
+
+
+def test_overlapping():
+    regions = [(1, 10, 20), (2, 30, 200), (3, 40, 50), (4, 900, 5)]
+    index = IntervalIndex(1, regions)
+    assert len(index) == 4
+    assert sorted(index.overlapping(0, 9)) == [4]
+    assert sorted(index.overlapping(20, 30)) == [1, 2]
+    assert sorted(index.overlapping(45, 45)) == [2, 3]
+    assert sorted(index.overlapping(201, 899)) == []
+    # areas crossing the origin
+    assert sorted(index.overlapping(950, 15)) == [1, 4]
+    assert sorted(index.overlapping(201, 25)) == [1, 4]
+
+
+def test_overlapping_random():
+    rng = random.Random(5)
+    regions = []
+    for region_id in range(200):
+        start = rng.randrange(10000)
+        end = start + rng.randrange(500) if region_id % 50 else rng.randrange(start)
+        regions.append((region_id, start, end))
+    index = IntervalIndex(None, regions)
+    for _ in range(500):
+        start, end = rng.randrange(10000), rng.randrange(10000)
+        expected = sorted(region[0] for region in regions if overlaps(region, start, end))
+        assert sorted(index.overlapping(start, end)) == expected
+
+
+def test_empty():
+    index = IntervalIndex(1, [])
+    assert index.overlapping(0, 100) == []
+    assert index.overlapping(100, 0) == []
@@ -82,3 +82,35 @@ def test_available_term_by_category():
     ]
     for args, expected in tests:
         assert available.available_term_by_category(*args) == expected, args
+
+
+def test_prefix_index():
+    index = available.PrefixIndex(['Class II', 'beta', None, 'class I', 'Alpha', 'beta', 'Class III'])
+    assert len(index) == 5
+    assert index.lookup('CLASS') == ['class I', 'Class II', 'Class III']
+    assert index.lookup('class ii') == ['Class II', 'Class III']
+    assert index.lookup('class', limit=1) == ['class I']
+    assert index.lookup('b') == ['beta']
+    assert index.lookup('gamma') == []
+    assert index.lookup('') == ['Alpha', 'beta', 'class I', 'Class II', 'Class III']
+
+
+def test_prefix_index_packed():
+    index = available.PrefixIndex(['NC_003903', 'NZ_JABQ01000018', 'NC_003888', None], packed=True)
+    assert len(index) == 3
+    assert index.lookup('nc_003') == ['NC_003888', 'NC_003903']
+    assert index.lookup('NZ') == ['NZ_JABQ01000018']
+
+
+def test_prefix_lookup_underscore(monkeypatch):
+    index = available.PrefixIndex(['NC_003888', 'NC_003903', 'NCX003000'])
+    monkeypatch.setattr(available, 'get_prefix_index', lambda _: index)
+    assert available.available_term_by_category('acc', 'NC_003') == [
+        {'val': 'NC_003888', 'desc': None},
+        {'val': 'NC_003903', 'desc': None},
+    ]
+
+
+def test_prefix_categories_registered():
+    for category in available.PREFIX_CATEGORIES:
+        assert category in available.AVAILABLE
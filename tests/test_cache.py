@@ -0,0 +1,168 @@
+'''Tests for the shared cache backends'''
+import hashlib
+import os
+from unittest.mock import patch
+
+import pytest
+
+from api import cache
+from api.cache import FileCache, LocalCache
+
+
+@pytest.fixture(params=["local", "filesystem"])
+def backend(request, tmp_path):
+    if request.param == "local":
+        return LocalCache(max_size=1024)
+    return FileCache(str(tmp_path))
+
+
+def test_get_set(backend):
+    assert backend.get("a") is None
+    backend.set("a", b"value")
+    assert backend.get("a") == b"value"
+    backend.set("a", b"other")
+    assert backend.get("a") == b"other"
+    backend.set("b", b"")
+    assert backend.get("b") == b""
+
+
+def test_delete_and_clear(backend):
+    backend.set("a", b"1")
+    backend.set("b", b"2")
+    backend.delete("a")
+    backend.delete("missing")
+    assert backend.get("a") is None
+    assert backend.get("b") == b"2"
+    backend.clear()
+    assert backend.get("b") is None
+
+
+def test_expiry(backend):
+    with patch.object(cache, "_now", return_value=100):
+        backend.set("a", b"1", ttl=60)
+        backend.set("b", b"2")
+    with patch.object(cache, "_now", return_value=150):
+        assert backend.get("a") == b"1"
+    with patch.object(cache, "_now", return_value=161):
+        assert backend.get("a") is None
+        assert backend.get("b") == b"2"
+
+
+def test_local_lru_eviction():
+    backend = LocalCache(max_size=6)
+    backend.set("a", b"12")
+    backend.set("b", b"34")
+    backend.set("c", b"56")
+    # touch "a", so "b" is the least recently used
+    assert backend.get("a")
+    backend.set("d", b"78")
+    assert backend.get("b") is None
+    assert backend.get("a") == b"12"
+    assert backend.get("c") == b"56"
+    assert backend.size == 6
+
+    # too large to store at all, and nothing is evicted for it
+    backend.set("e", b"1234567")
+    assert backend.get("e") is None
+    assert len(backend) == 3
+
+
+def test_file_shared(tmp_path):
+    first = FileCache(str(tmp_path))
+    second = FileCache(str(tmp_path))
+    first.set("a", b"shared")
+    assert second.get("a") == b"shared"
+    second.clear()
+    assert first.get("a") is None
+
+
+def test_file_eviction(tmp_path):
+    backend = FileCache(str(tmp_path), max_size=100)
+    backend.SWEEP_INTERVAL = 0
+    for key in "abc":
+        backend.set(key, b"x" * 22)
+    # recently read entries are kept
+    os.utime(backend._path("a"), (1, 1))
+    os.utime(backend._path("b"), (1, 1))
+    assert backend.get("b") is not None
+    backend.set("d", b"x" * 22)
+    assert backend.get("a") is None
+    assert backend.get("b") is not None
+    assert backend.get("d") is not None
+
+    # expired entries are removed without being read again
+    with patch.object(cache, "_now", return_value=0):
+        backend.set("e", b"e", ttl=1)
+    backend.sweep()
+    assert not os.path.exists(backend._path("e"))
+
+
+def test_file_errors_not_fatal(tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_bytes(b"")
+    backend = FileCache(str(blocker / "cache"))
+    backend.set("a", b"value")
+    assert backend.get("a") is None
+    backend.delete("a")
+    backend.clear()
+    backend.sweep()
+
+
+def test_memoise():
+    calls = []
+
+    @cache.memoise("test")
+    def double(value):
+        calls.append(value)
+        return {"double": value * 2}
+
+    backend = LocalCache()
+    with patch.object(cache, "get_cache", return_value=backend), \
+         patch.object(cache, "database_version", return_value="1"):
+        assert double(2) == {"double": 4}
+        assert double(2) == {"double": 4}
+        assert double(3) == {"double": 6}
+        assert calls == [2, 3]
+
+    # a new database version runs the function again
+    with patch.object(cache, "get_cache", return_value=backend), \
+         patch.object(cache, "database_version", return_value="2"):
+        assert double(2) == {"double": 4}
+        assert calls == [2, 3, 2]
+
+
+def test_cached_payload_args():
+    calls = []
+
+    def build(name="all"):
+        calls.append(name)
+        return name.encode()
+
+    backend = LocalCache()
+    with patch.object(cache, "get_cache", return_value=backend), \
+         patch.object(cache, "database_version", return_value="1"):
+        assert cache.cached_payload("tree", build)[0] == b"all"
+        assert cache.cached_payload("tree", build, args=("nrps",))[0] == b"nrps"
+        assert cache.cached_payload("tree", build, args=("nrps",))[0] == b"nrps"
+        assert cache.cached_payload("tree", build)[0] == b"all"
+        assert calls == ["all", "nrps"]
+
+
+def test_cached_payload_digest():
+    calls = []
+
+    def build():
+        calls.append(1)
+        return b"payload"
+
+    backend = LocalCache()
+    with patch.object(cache, "get_cache", return_value=backend), \
+         patch.object(cache, "database_version", return_value="1"):
+        payload, _, digest = cache.cached_payload("tree", build)
+        assert payload == b"payload"
+        assert digest == hashlib.sha1(b"payload").hexdigest()
+        # the digest is stored with the payload, not recalculated
+        with patch.object(cache.hashlib, "sha1") as sha1:
+            assert cache.cached_payload("tree", build)[2] == digest
+            sha1.assert_not_called()
+        assert calls == [1]
@@ -292,6 +292,20 @@ def test_clusters_by_modules():
             raise
 
 
+def test_clusters_by_modules_sections_filtered(query_budget):
+    def regions(query):
+        return {region.region_id for region in clusters.clusters_by_modulequery(query)}
+
+    loading = regions("L=AMP-binding")
+    carrier = regions("T=PCP")
+    with query_budget(3) as statements:
+        combined = regions("L=AMP-binding|T=PCP")
+    assert combined
+    assert combined <= loading & carrier
+    # later sections only look at the modules matching the earlier ones
+    assert "module_id = ANY" in statements[1]
+
+
 def test_clusters_by_module_filters():
     assert get_count(clusters.clusters_by_substrate('ala')) == 2
     base = clusters.clusters_by_modulequery("L=AMP-binding")
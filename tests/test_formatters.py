@@ -0,0 +1,29 @@
+'Tests for the number of queries run by the search result formatters'
+
+import pytest
+from flask import g
+
+from api.models import AsDomain, Cds, Region
+from api.search import (
+    CLUSTER_FORMATTERS,
+    DOMAIN_FORMATTERS,
+    GENE_FORMATTERS,
+)
+
+FORMATTERS = [
+    (Region, CLUSTER_FORMATTERS),
+    (Cds, GENE_FORMATTERS),
+    (AsDomain, DOMAIN_FORMATTERS),
+]
+
+# the loading of the records, plus the queries of the formatter
+QUERY_BUDGET = 3
+
+
+@pytest.mark.parametrize("model, formatters", FORMATTERS)
+def test_formatter_query_budget(app, query_budget, model, formatters):
+    for name, formatter in formatters.items():
+        with app.test_request_context(), query_budget(QUERY_BUDGET):
+            g.verbose = False
+            entities = model.query.limit(20).all()
+            assert list(formatter(entities)), name
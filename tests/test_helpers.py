@@ -17,3 +17,45 @@ def test_calculate_sequence():
     assert helpers.calculate_sequence(comp, seq) == "ATGTGA"
     comp.strand = -1
     assert helpers.calculate_sequence(comp, seq) == helpers.reverse_complement("ATGTGA")
+
+
+def test_id_filter(app):
+    from sqlalchemy.dialects import postgresql
+    from api.models import Region
+
+    clause = helpers.id_filter(Region.region_id, iter(range(50000, 0, -1)))
+    compiled = clause.compile(dialect=postgresql.dialect())
+    assert str(compiled) == "antismash.regions.region_id = ANY (%(ids_1)s::INTEGER[])"
+    assert compiled.params["ids_1"] == list(range(1, 50001))
+
+    # subqueries are left to a plain IN
+    subquery = Region.query.with_entities(Region.region_id).filter(Region.contig_edge)
+    assert " IN (SELECT" in str(helpers.id_filter(Region.region_id, subquery).compile(dialect=postgresql.dialect()))
+
+
+def test_slice_statement(app):
+    from sqlalchemy.dialects import postgresql
+
+    compiled = str(helpers.slice_statement().compile(dialect=postgresql.dialect()))
+    # only the requested coordinates are selected, numbered in the order given
+    assert "substr(antismash.dna_sequences.dna, slices.start + " in compiled
+    assert "unnest(%(accessions)s::TEXT[], %(starts)s::INTEGER[], %(stops)s::INTEGER[]) WITH ORDINALITY AS slices(accession, start, stop, n)" in compiled
+
+def test_fetch_sequences(monkeypatch):
+    records = {"A": "ATGCCCTGA", "B": "GGGAAATTT"}
+    requested = []
+
+    def fetch_slices(slices):
+        requested.extend(slices)
+        return [records[acc][start:end] for acc, start, end in slices]
+
+    monkeypatch.setattr(helpers, "fetch_slices", fetch_slices)
+    comp = CompoundLocation([Location(0, 3, 1), Location(6, 9, 1)])
+    features = [
+        ("A", comp),
+        ("B", Location(3, 6, -1)),
+        ("A", Location(0, 3, -1)),
+    ]
+    assert helpers.fetch_sequences(features) == ["ATGTGA", "TTT", "CAT"]
+    # shared parts are only fetched once, grouped by record
+    assert requested == [("A", 0, 3), ("A", 6, 9), ("B", 3, 6)]
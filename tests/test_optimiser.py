@@ -0,0 +1,63 @@
+from api.search.optimiser import optimise
+from api.search_parser import QueryTerm
+
+SIZES = {
+    'nrps': 100,
+    't1pks': 50,
+    'ripp': 10,
+    'none': 0,
+}
+
+
+def estimate(operand):
+    return SIZES[operand.term]
+
+
+def test_single_operand_unchanged():
+    term = QueryTerm.from_string("{[type|none]}")
+    assert optimise(term, lambda _: 1 / 0) is term
+
+
+def test_and_flattened_and_ordered():
+    result = optimise(QueryTerm.from_string("(({[type|nrps]} AND {[type|t1pks]}) AND {[type|ripp]})"), estimate)
+    assert result.operator == 'and'
+    assert result.right.term == 'nrps'
+    assert result.left.left.term == 'ripp'
+    assert result.left.right.term == 't1pks'
+
+
+def test_duplicates_removed():
+    result = optimise(QueryTerm.from_string("(({[type|nrps]} OR {[type|ripp]}) OR {[type|nrps]})"), estimate)
+    assert result.kind == 'operation'
+    assert {result.left.term, result.right.term} == {'nrps', 'ripp'}
+
+    result = optimise(QueryTerm.from_string("({[type|nrps]} AND {[type|nrps]})"), estimate)
+    assert result.kind == 'expression'
+    assert result.term == 'nrps'
+
+
+def test_empty_branches():
+    # an empty AND operand empties the whole chain
+    result = optimise(QueryTerm.from_string("(({[type|nrps]} AND {[type|none]}) AND {[type|ripp]})"), estimate)
+    assert result.kind == 'expression' and result.term == 'none'
+
+    # empty OR operands are dropped
+    result = optimise(QueryTerm.from_string("(({[type|nrps]} OR {[type|none]}) OR {[type|ripp]})"), estimate)
+    assert result.operator == 'or'
+    assert {result.left.term, result.right.term} == {'nrps', 'ripp'}
+
+    # nothing to exclude
+    result = optimise(QueryTerm.from_string("({[type|nrps]} EXCEPT {[type|none]})"), estimate)
+    assert result.kind == 'expression' and result.term == 'nrps'
+
+    # nothing to exclude from
+    result = optimise(QueryTerm.from_string("({[type|none]} EXCEPT ({[type|nrps]} OR {[type|ripp]}))"), estimate)
+    assert result.kind == 'expression' and result.term == 'none'
+
+
+def test_except_structure_kept():
+    result = optimise(QueryTerm.from_string("(({[type|nrps]} AND {[type|ripp]}) EXCEPT {[type|t1pks]})"), estimate)
+    assert result.operator == 'except'
+    assert result.left.operator == 'and'
+    assert result.left.left.term == 'ripp'
+    assert result.right.term == 't1pks'
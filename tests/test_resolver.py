@@ -0,0 +1,67 @@
+'Tests for the in-memory goto identifier resolver'
+
+from bisect import bisect_left
+import threading
+
+from api import resolver as resolver_module
+from api.resolver import IdentifierResolver, PackedStrings
+
+
+def test_packed_strings():
+    strings = ["", "abc", "abd", "b"]
+    packed = PackedStrings(strings)
+    assert len(packed) == 4
+    assert list(packed) == strings
+    assert bisect_left(packed, "abd") == 2
+    assert bisect_left(packed, "c") == 4
+
+
+def test_resolve():
+    resolver = IdentifierResolver(
+        ["GCF_000203835.1", "GCF_000590515.1", None],
+        [("NC_003888", "GCF_000203835.1"), ("NC_003903", "GCF_000203835.1"),
+         ("NZ_AZXO01000001", "GCF_000590515.1"), ("NZ_ORPHAN", None)],
+        [("GCF_000203835.1", "NC_003888")],
+    )
+    # assembly ids take precedence, with case-insensitive prefixes
+    assert resolver.resolve("GCF_000203835.1") == "GCF_000203835.1"
+    assert resolver.resolve("gcf_0005") == "GCF_000590515.1"
+    assert resolver.resolve("GCF") == "GCF_000203835.1"
+    # then record accessions
+    assert resolver.resolve("NC_003903") == "GCF_000203835.1"
+    assert resolver.resolve("nz_azxo") == "GCF_000590515.1"
+    assert resolver.resolve("NZ_ORPHAN") is None
+    assert resolver.resolve("NC_1") is None
+
+    assert resolver.base_filename("GCF_000203835.1") == "NC_003888"
+    assert resolver.base_filename("GCF_000590515.1") is None
+
+
+def test_rebuild_without_blocking(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    versions = iter(["1", "2"])
+
+    def build():
+        version = next(versions)
+        if version == "2":
+            started.set()
+            assert release.wait(5)
+        return version
+
+    monkeypatch.setattr(resolver_module, "_RESOLVER", {"current": (None, None)})
+    monkeypatch.setattr(resolver_module, "build_resolver", build)
+    monkeypatch.setattr(resolver_module, "database_version", lambda: "1")
+    assert resolver_module.get_resolver() == "1"
+
+    # after the database changed, one request rebuilds while the others keep the old resolver
+    monkeypatch.setattr(resolver_module, "database_version", lambda: "2")
+    rebuilt = []
+    builder = threading.Thread(target=lambda: rebuilt.append(resolver_module.get_resolver()))
+    builder.start()
+    assert started.wait(5)
+    assert resolver_module.get_resolver() == "1"
+    release.set()
+    builder.join(5)
+    assert rebuilt == ["2"]
+    assert resolver_module.get_resolver() == "2"
@@ -0,0 +1,42 @@
+'''Tests for the search result id cache'''
+from array import array
+
+from api import cache
+from api.cache import LocalCache
+from api.search import result_cache
+from api.search.result_cache import decode_ids, encode_ids
+
+
+def test_encode_decode():
+    for ids in [array('q'), array('q', [1]), array('q', [1, 2, 3, 1000, 2 ** 40]), array('l', [5, 7, 9])]:
+        blob = encode_ids(ids)
+        assert isinstance(blob, bytes)
+        assert list(decode_ids(blob)) == list(ids)
+
+
+def test_encode_compact():
+    ids = array('q', range(100000))
+    assert len(encode_ids(ids)) < len(ids) * ids.itemsize / 4
+
+
+def test_oversized_ids(app, monkeypatch):
+    backend = LocalCache()
+    monkeypatch.setattr(result_cache, 'get_cache', lambda: backend)
+    monkeypatch.setattr(cache, 'database_version', lambda: '1')
+    monkeypatch.setitem(app.config, 'RESULT_CACHE_MAX_IDS', 10)
+
+    assert result_cache.set_cached_ids('small', array('q', range(10)))
+    assert list(result_cache.get_cached_ids('small')) == list(range(10))
+
+    # too many ids
+    assert not result_cache.set_cached_ids('many', array('q', range(11)))
+    assert result_cache.get_cached_ids('many') is None
+
+    # too large for the backend, e.g. memcached's item size limit
+    backend.max_item_size = 4
+    assert not result_cache.set_cached_ids('large', array('q', range(10)))
+    assert result_cache.get_cached_ids('large') is None
+
+    assert result_cache.get_oversized_total('many') is None
+    result_cache.set_oversized_total('many', 12345)
+    assert result_cache.get_oversized_total('many') == 12345
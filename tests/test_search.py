@@ -1,6 +1,9 @@
+from unittest.mock import patch
+
 import pytest
-from api import search
-from api.search_parser import QueryOperand, QueryOperation
+from api import cache, search
+from api.cache import LocalCache
+from api.search_parser import Query, QueryOperand, QueryOperation
 
 from .test_clusters import TOTAL_REGION_COUNT
 
@@ -91,3 +94,188 @@ def test_cluster_query_from_term_invalid():
         assert False, "missing exception"
     except search.helpers.UnknownQueryError:
         pass
+
+
+def test_paginated_search():
+    query = Query.from_string("{[genus|Streptomyces]}")
+    everything = search.core_search(query)
+    assert search.count_results(query) == len(everything) == TOTAL_REGION_COUNT
+
+    total, results = search.paginated_search(query, offset=0, paginate=5)
+    assert total == TOTAL_REGION_COUNT
+    assert [r.region_id for r in results] == [r.region_id for r in everything[:5]]
+
+    total, results = search.paginated_search(query, offset=10, paginate=5)
+    assert [r.region_id for r in results] == [r.region_id for r in everything[10:15]]
+
+    total, results = search.paginated_search(query, offset=TOTAL_REGION_COUNT - 2, paginate=5)
+    assert len(results) == 2
+
+    # no pagination returns everything from the offset
+    total, results = search.paginated_search(query, offset=3, paginate=0)
+    assert len(results) == TOTAL_REGION_COUNT - 3
+
+
+def test_operations_use_ids_only(app):
+    query = Query.from_string("({[genus|Streptomyces]} AND {[species|coelicolor]})", search_type="gene")
+    ids = str(search.gene_ids_from_term(query.terms))
+    assert "INTERSECT" in ids
+    assert "translation" not in ids
+
+    query = Query.from_string("(({[genus|Streptomyces]} OR {[contigedge]}) EXCEPT {[species|coelicolor]})")
+    ids = str(search.cluster_ids_from_term(query.terms))
+    assert "UNION" in ids and "EXCEPT" in ids
+    assert "contig_edge AS" not in ids
+    # the regions themselves are joined back to the combined ids
+    assert "JOIN (" in str(search.cluster_query_from_term(query.terms))
+
+
+def test_explain():
+    from sqlalchemy import select
+    from sqlalchemy.dialects import postgresql
+    from api.models import Region
+
+    statement = select(Region.region_id)
+    compiled = str(search.explain(statement).compile(dialect=postgresql.dialect()))
+    assert compiled.startswith("EXPLAIN SELECT")
+    compiled = str(search.explain(statement, analyze=True, json=True).compile(dialect=postgresql.dialect()))
+    assert compiled.startswith("EXPLAIN (ANALYZE, FORMAT JSON) SELECT")
+
+
+def test_region_stats_facets():
+    query = Query.from_string("{[type|furan]}")
+    stats = search.region_stats(query, ['type', 'genus', 'contigedge', 'bogus'])
+    assert set(stats) == {'clusters_by_type', 'clusters_by_genus', 'clusters_by_contigedge'}
+    assert stats['clusters_by_genus'] == {'labels': ['Streptomyces'], 'data': [1]}
+    assert stats['clusters_by_contigedge'] == {'labels': ['false'], 'data': [1]}
+
+    gene_query = Query.from_string("{[type|furan]}", search_type="gene")
+    assert search.region_stats(gene_query, ['genus']) == {'clusters_by_genus': {'labels': ['Streptomyces'], 'data': [1]}}
+
+
+def test_streamed_search():
+    query = Query.from_string("{[genus|Streptomyces]}")
+    everything = search.core_search(query)
+
+    streamed = search.core_search(query, stream=True, batch_size=7)
+    assert not isinstance(streamed, list)
+    assert [r.region_id for r in streamed] == [r.region_id for r in everything]
+
+
+def test_id_only_search():
+    query = Query.from_string("{[genus|Streptomyces]}")
+    everything = search.core_search(query)
+
+    ids = search.core_search(query, ids_only=True)
+    assert ids == [r.region_id for r in everything]
+    assert list(search.core_search(query, stream=True, batch_size=7, ids_only=True)) == ids
+
+
+def test_cursor_roundtrip():
+    query = Query.from_string("{[type|nrps]}")
+    token = search.encode_cursor(query, 1234)
+    assert isinstance(token, str)
+    assert search.decode_cursor(query, token) == 1234
+    # the return type doesn't change the results, so shouldn't change the cursor
+    assert search.decode_cursor(Query.from_string("{[type|nrps]}", return_type="csv"), token) == 1234
+
+    assert search.decode_cursor(query, "") is None
+    assert search.decode_cursor(query, None) is None
+
+
+def test_cursor_invalid():
+    query = Query.from_string("{[type|nrps]}")
+    token = search.encode_cursor(query, 1234)
+
+    with pytest.raises(search.helpers.InvalidQueryError, match="does not match"):
+        search.decode_cursor(Query.from_string("{[type|t1pks]}"), token)
+    with pytest.raises(search.helpers.InvalidQueryError, match="does not match"):
+        search.decode_cursor(Query.from_string("{[type|nrps]}", search_type="gene"), token)
+
+    for bad in ["bogus", "e30=", token[:-3], 17]:
+        with pytest.raises(search.helpers.InvalidQueryError, match="Invalid cursor"):
+            search.decode_cursor(query, bad)
+
+
+def test_cursor_search():
+    query = Query.from_string("{[genus|Streptomyces]}")
+    everything = [r.region_id for r in search.core_search(query)]
+
+    seen = []
+    after = None
+    while True:
+        total, results = search.paginated_search(query, paginate=50, after=after)
+        assert total == TOTAL_REGION_COUNT
+        seen.extend(r.region_id for r in results)
+        token = search.next_cursor(query, results, 50)
+        if token is None:
+            break
+        after = search.decode_cursor(query, token)
+    assert seen == everything
+
+
+def test_operand_cardinality_cached_only():
+    backend = LocalCache()
+    query = Query(QueryOperand(category='type', value='nrps'), search_type='cluster')
+    operand = query.terms.to_json()
+    with patch.object(search, "get_cache", return_value=backend), \
+         patch.object(cache, "database_version", return_value="1"), \
+         patch.object(search, "operand_estimate", return_value=7) as estimate:
+        # without a cached count, only the planner is asked
+        assert search.known_cardinality('cluster', operand) is None
+        assert search.operand_cardinality('cluster', operand) == 7
+        estimate.assert_called_once_with('cluster', operand)
+
+        # exact counts of earlier searches are used, including empty ones
+        search.remember_cardinality(query, 0)
+        assert search.operand_cardinality('cluster', operand) == 0
+        assert estimate.call_count == 1
+
+        # counts of whole query trees aren't operand counts
+        tree = Query(QueryOperation('and', query.terms, query.terms), search_type='cluster')
+        search.remember_cardinality(tree, 3)
+        assert search.known_cardinality('cluster', tree.terms.to_json()) is None
+
+
+def test_paginated_search_oversized(app, monkeypatch):
+    query = Query.from_string("{[genus|Streptomyces]}")
+    everything = [r.region_id for r in search.core_search(query)]
+    monkeypatch.setitem(app.config, 'RESULT_CACHE_MAX_IDS', 3)
+    cache.get_cache().clear()
+
+    total, results = search.paginated_search(query, offset=0, paginate=5)
+    assert total == TOTAL_REGION_COUNT
+    assert [r.region_id for r in results] == everything[:5]
+    # the ids are marked as too many to cache, later pages use the database
+    assert search.cached_result_ids(query) == (None, TOTAL_REGION_COUNT)
+
+    total, results = search.paginated_search(query, offset=5, paginate=5)
+    assert total == TOTAL_REGION_COUNT
+    assert [r.region_id for r in results] == everything[5:10]
+
+    seen = []
+    after = None
+    while True:
+        total, results = search.paginated_search(query, paginate=2, after=after)
+        assert total == TOTAL_REGION_COUNT
+        seen.extend(r.region_id for r in results)
+        token = search.next_cursor(query, results, 2)
+        if token is None:
+            break
+        after = search.decode_cursor(query, token)
+    assert seen == everything
+    assert search.result_count(query) == TOTAL_REGION_COUNT
+
+
+def test_region_stats_cached_ids(app, query_budget):
+    query = Query.from_string("{[type|furan]}")
+    expected = search.region_stats(query, ['genus'])
+    cache.get_cache().clear()
+    ids = search.result_ids(query)
+    assert list(ids)
+
+    with query_budget(1) as statements:
+        assert search.region_stats(query, ['genus']) == expected
+    # the search itself isn't run again
+    assert "bgc_types" not in statements[0]
+    assert "ANY" in statements[0]
@@ -0,0 +1,49 @@
+'Tests for the packed DNA sequence store'
+
+import pytest
+
+from api import sequence_store
+from api.sequence_store import SequenceStore, write_store
+
+RECORDS = [
+    ("A", "ATGCCCTGA"),
+    ("B", "acgtNNRYKM"),
+    ("C", "ATXZ"),
+    ("D", ""),
+    ("E", "aaCCgTtXnn*"),
+]
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = tmp_path / "sequences.bin"
+    assert write_store(str(path), RECORDS, "2-5") == len(RECORDS)
+    store = SequenceStore(str(path))
+    yield store
+    store.close()
+
+
+def test_pack_roundtrip():
+    for sequence in [b"", b"A", b"AC", b"ACG", b"ACGTRYSWKMBDHVN-"]:
+        packed = sequence_store.pack(sequence)
+        assert len(packed) == (len(sequence) + 1) // 2
+        assert sequence_store.unpack(packed, 0, len(sequence)) == sequence
+
+
+def test_store_slices(store):
+    assert store.version == "2-5"
+    assert "A" in store and "F" not in store
+    for accession, dna in RECORDS:
+        for start in range(len(dna)):
+            for end in range(start, len(dna) + 1):
+                assert store.slice(accession, start, end) == dna[start:end]
+    # slices are clipped to the record
+    assert store.slice("A", -3, 100) == "ATGCCCTGA"
+    assert store.slice("D", 0, 10) == ""
+
+
+def test_invalid_store(tmp_path):
+    path = tmp_path / "invalid.bin"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        SequenceStore(str(path))
@@ -8,6 +8,7 @@ from api.taxtree import (
     get_genus,
     get_species,
     get_strains,
+    TaxonIndex,
     _create_tree_node,
 )
 
@@ -141,3 +142,43 @@ def test__create_tree_node(session):
     }
     node = _create_tree_node(expected['id'], expected['parent'], expected['text'], assembly_id=expected['assembly_id'], disabled=False, leaf=True)
     assert node == expected
+
+
+def test_taxon_index():
+    lineage = ('Bacteria', 'Actinomycetota', 'Actinomycetes', 'Kitasatosporales', 'Streptomycetaceae', 'Streptomyces')
+    taxa = [
+        (1, *lineage, 'coelicolor', 'A3(2)'),
+        (2, *lineage, 'Unclassified', 'sp. 1'),
+        (3, *lineage, 'Unclassified', 'sp. 2'),
+        (4, *lineage, 'griseus', 'no genomes'),
+    ]
+    genomes = [(1, 'GCF_1'), (2, 'GCF_3'), (3, 'GCF_2'), (2, 'GCF_4')]
+    index = TaxonIndex(taxa, genomes)
+
+    assert index.children_of([]) == [('Bacteria', 4)]
+    assert index.children_of(['bacteria', 'ACTINOMYCETOTA']) == [('Actinomycetes', 4)]
+    assert index.children_of([name.lower() for name in lineage]) == [('coelicolor', 1), ('Unclassified', 3)]
+    assert index.children_of(['archaea']) == []
+
+    strains = index.strains_of([name.lower() for name in lineage] + ['unclassified'])
+    assert [strain[0] for strain in strains] == ['sp. 1', 'sp. 1', 'sp. 2']
+    assert [strain[3] for strain in strains] == ['GCF_3', 'GCF_4', 'GCF_2']
+
+    assert [hit[6] for hit in index.search('GRIS')] == ['griseus']
+    assert [hit[6] for hit in index.search('sp.')] == ['Unclassified', 'Unclassified']
+    assert index.search('nothing') == []
+
+
+def test_taxon_index_search():
+    lineage = ('Bacteria', 'Actinomycetota', 'Actinomycetes', 'Kitasatosporales', 'Streptomycetaceae', 'Streptomyces')
+    taxa = [(i, *lineage, species, f'strain {i}') for i, species in enumerate(['coelicolor', 'griseus', 'albus'])]
+    index = TaxonIndex(taxa, [])
+
+    # short terms can't use the n-grams
+    assert [hit[6] for hit in index.search('us')] == ['griseus', 'albus']
+    assert [hit[6] for hit in index.search('coel')] == ['coelicolor']
+    # n-grams shared by different names don't match
+    assert index.search('colus') == []
+    # matches via the genus
+    assert len(index.search('streptomyces')) == 3
+    assert len(index.search('streptomyces', limit=2)) == 2